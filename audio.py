@@ -0,0 +1,67 @@
+from functools import lru_cache
+from io import BytesIO
+
+import numpy as np
+
+# The log-mel spectrogram has a 25ms window every 10ms, so that frame i starts at i * 10ms of the clip
+MEL_WINDOW = 0.025
+MEL_HOP = 0.01
+
+
+def hz_to_mel(x):
+    return 2595 * np.log10(1 + x / 700)
+
+
+def mel_to_hz(x):
+    return 700 * (10 ** (x / 2595) - 1)
+
+
+@lru_cache()
+def mel_filterbank(rate, n_fft, mel_bins):
+    # Triangular filters evenly spaced on the mel scale, from 0 to the Nyquist frequency, in (n_fft / 2 + 1, mel_bins)
+    edges = mel_to_hz(np.linspace(0, hz_to_mel(rate / 2), mel_bins + 2))
+    freqs = np.fft.rfftfreq(n_fft, 1 / rate)
+    rising = (freqs[None, :] - edges[:-2, None]) / (edges[1:-1] - edges[:-2])[:, None]
+    falling = (edges[2:, None] - freqs[None, :]) / (edges[2:] - edges[1:-1])[:, None]
+    return np.maximum(0, np.minimum(rising, falling)).T.astype(np.float32)
+
+
+def log_mel(samples, rate, mel_bins, batch_frames=1024):
+    # The spectrogram frames are views of the samples, and are transformed a batch at a time,
+    # so that a long clip never has all the spectra of the FFT in memory at once
+    window, hop = int(round(rate * MEL_WINDOW)), int(round(rate * MEL_HOP))
+    n_fft = 1 << (window - 1).bit_length()
+    samples = samples.astype(np.float32) / 32768
+    if len(samples) < window:
+        return np.zeros((0, mel_bins), dtype=np.float32)
+
+    frames = np.lib.stride_tricks.sliding_window_view(samples, window)[::hop]
+    hann = np.hanning(window).astype(np.float32)
+    filterbank = mel_filterbank(rate, n_fft, mel_bins)
+    output = np.empty((len(frames), mel_bins), dtype=np.float32)
+    for x in range(0, len(frames), batch_frames):
+        power = np.abs(np.fft.rfft(frames[x:x + batch_frames] * hann, n=n_fft)) ** 2
+        output[x:x + batch_frames] = np.log(power.astype(np.float32) @ filterbank + 1e-6)
+    return output
+
+
+def encode_audio(args, pcm):
+    # The mono 16-bit pcm from ffmpeg, saved as it is, or as the log-mel spectrogram, in the .npy format
+    samples = np.frombuffer(pcm, dtype="<i2")
+    data = samples if args.audio == "pcm" else log_mel(samples, args.audio_rate, args.mel_bins)
+    f = BytesIO()
+    np.save(f, data)
+    return f.getvalue()
+
+
+def audio_meta(args):
+    # Saved with every video, to tell how the audio of the clips is to be read
+    if args.audio == "pcm":
+        return {"format": "pcm", "rate": args.audio_rate}
+    return {"format": "logmel", "rate": args.audio_rate, "mel_bins": args.mel_bins,
+            "window": MEL_WINDOW, "hop": MEL_HOP}
+
+
+def decode_audio(data):
+    # An int16 array of samples for `pcm`, or a (frames, mel_bins) float32 array for `logmel`
+    return np.load(BytesIO(bytes(data)))
@@ -0,0 +1,302 @@
+import json
+import os
+import pickle
+import platform
+import shutil
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from itertools import product
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+CONTAINERS = {"libx264": "mp4", "mpeg4": "mp4", "libvpx": "webm", "libvpx-vp9": "webm"}
+
+RESIZE = {0: [], 1: ["--resize", "160x120"], 2: ["--resize", "S128"]}
+
+READERS = {
+    "HDF5": ("pytorch_hdf5_video_dataset", "HDF5VideoDataset"),
+    "LMDB": ("pytorch_lmdb_video_dataset", "LMDBVideoDataset"),
+    "FILE": ("pytorch_file_video_dataset", "FileVideoDataset"),
+    "PKL": ("pytorch_pkl_video_dataset", "PKLVideoDataset"),
+    "NPY": ("pytorch_npy_video_dataset", "NPYVideoDataset"),
+    "TAR": ("pytorch_tar_video_dataset", "TarVideoDataset"),
+}
+
+
+def parse_args():
+    description = """
+    This is a benchmark of video2frame.py, on synthetic videos made by `ffmpeg -f lavfi -i testsrc2`.
+
+    The videos are made once in the work folder, for every resolution, codec and length.
+    Then every combination of `db_type`, `threads`, `sample_mode` and `resize_mode` is extracted,
+    and read back by the dataset in `examples/`.
+    The results are saved in json, and compared with the `baseline` results if given.
+    """
+    parser = ArgumentParser(description=description, formatter_class=RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command")
+
+    run_parser = subparsers.add_parser("run", help="Run the benchmark")
+    run_parser.add_argument("--work_dir", type=str, default="/tmp/video2frame_benchmark",
+                            help="The folder for the videos and the databases")
+    run_parser.add_argument("--output", type=str, default="benchmark.json", help="The results, in json format")
+    run_parser.add_argument("--baseline", type=str, help="The results of an earlier version to compare with")
+    run_parser.add_argument("--resolutions", type=str, default="320x240,1280x720")
+    run_parser.add_argument("--codecs", type=str, default="libx264,mpeg4")
+    run_parser.add_argument("--lengths", type=str, default="2,10", help="Seconds of each video")
+    run_parser.add_argument("--copies", type=int, default=2, help="Times each video is listed in the annotation")
+    run_parser.add_argument("--db_types", type=str, default="HDF5,LMDB,FILE,PKL,NPY,TAR")
+    run_parser.add_argument("--threads", type=str, default="0,4")
+    run_parser.add_argument("--sample_modes", type=str, default="0,1", help="`--sample 16` is used")
+    run_parser.add_argument("--resize_modes", type=str, default="0,1", help="`160x120` or `S128` is used")
+    run_parser.add_argument("--frames", type=int, default=16, help="Num of frames per clip, when reading")
+
+    # Run by `run` in a separate process, so that the peak memory is of the reader alone
+    read_parser = subparsers.add_parser("read", help="Time the dataset of a database")
+    read_parser.add_argument("db_type", type=str, choices=sorted(READERS))
+    read_parser.add_argument("annotation", type=str)
+    read_parser.add_argument("database", type=str)
+    read_parser.add_argument("--frames", type=int, default=16)
+
+    args = parser.parse_args()
+    if not args.command:
+        parser.error("Please choose a command")
+    return args
+
+
+def make_videos(args, video_dir):
+    video_dir.mkdir(exist_ok=True, parents=True)
+    encoders = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+
+    videos = []
+    for resolution, codec, length in product(args.resolutions.split(","), args.codecs.split(","),
+                                             args.lengths.split(",")):
+        if " {} ".format(codec) not in encoders:
+            print("Skip codec {}, not supported by ffmpeg".format(codec))
+            continue
+        video_file = video_dir / "{}_{}_{}s.{}".format(resolution, codec, length, CONTAINERS.get(codec, "mkv"))
+        if not video_file.exists():
+            # Bit-exact output, so that the same ffmpeg always makes the same videos
+            cmd = [
+                "ffmpeg", "-y", "-loglevel", "error",
+                "-f", "lavfi", "-i", "testsrc2=size={}:rate=25:duration={}".format(resolution, length),
+                "-c:v", codec, "-pix_fmt", "yuv420p",
+                "-fflags", "+bitexact", "-flags:v", "+bitexact", "-map_metadata", "-1",
+                str(video_file) + ".tmp." + video_file.suffix[1:]
+            ]
+            subprocess.run(cmd, check=True)
+            Path(cmd[-1]).replace(video_file)
+        videos.append(video_file)
+    return videos
+
+
+def make_annotation(args, videos, annotation_file):
+    annotation = {}
+    for ith_video, video_file in enumerate(videos):
+        for ith_copy in range(args.copies):
+            annotation["{}_{}".format(video_file.stem, ith_copy)] = {"path": str(video_file), "class": ith_video}
+    data = {"meta": {"class_num": len(videos), "class_name": [x.stem for x in videos]}, "annotation": annotation}
+    json.dump(data, annotation_file.open("w"), indent=4)
+    return len(annotation)
+
+
+def run_with_rusage(cmd):
+    # The peak RSS is the largest of the process and its waited children, e.g. ffmpeg and the workers
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=str(ROOT))
+    output = proc.stdout.read()
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    seconds = time.perf_counter() - start
+    return proc.returncode, output, seconds, rusage.ru_maxrss * 1024
+
+
+def get_size(path):
+    if path.is_file():
+        return path.stat().st_size
+    return sum(x.stat().st_size for x in path.rglob("*") if x.is_file())
+
+
+def count_frames(db_type, path):
+    # The audio of the clips (at `video/audio/clip`) is not counted
+    if db_type == "HDF5":
+        import h5py
+        counter = []
+        with h5py.File(str(path), "r") as f:
+            f.visititems(lambda name, obj: counter.append(len(obj) if obj.ndim else 1)
+                         if isinstance(obj, h5py.Dataset) and "/audio/" not in name else None)
+        return sum(counter)
+    elif db_type == "LMDB":
+        import lmdb
+        with lmdb.open(str(path), readonly=True, lock=False) as env, env.begin() as txn:
+            return sum(1 for key in txn.cursor().iternext(values=False)
+                       if not key.startswith(b"__") and b"/audio/" not in key)
+    elif db_type == "FILE":
+        return len(list(path.rglob("*.jpg")))
+    elif db_type == "PKL":
+        return sum(len(pickle.load(x.open("rb"))) for x in path.rglob("*.pkl"))
+    elif db_type == "NPY":
+        import numpy as np
+        return sum(len(np.load(str(x), mmap_mode="r")) for x in path.rglob("*.npy") if x.parent.name != "audio")
+    elif db_type == "TAR":
+        return sum(len(clip) for x in path.glob("shard-*.json")
+                   for clips in json.load(x.open())["videos"].values() for clip in clips)
+    raise ValueError("Unknown db_type {}".format(db_type))
+
+
+def run_extract(args, db_type, threads, sample_mode, resize_mode, annotation_file, db_dir, num_videos):
+    db_name = db_dir / "{}-t{}-s{}-r{}".format(db_type, threads, sample_mode, resize_mode)
+    if db_type == "HDF5":
+        db_name = db_name.with_suffix(".hdf5")
+    elif db_type == "LMDB":
+        db_name = db_name.with_suffix(".lmdb")
+
+    cmd = [
+        sys.executable, "video2frame.py", str(annotation_file),
+        "--db_name", str(db_name), "--db_type", db_type,
+        "--threads", str(threads),
+        "--resize_mode", str(resize_mode), *RESIZE[resize_mode],
+        "--sample_mode", str(sample_mode),
+    ]
+    if sample_mode:
+        cmd.extend(["--sample", "16"])
+
+    returncode, output, seconds, peak_rss = run_with_rusage(cmd)
+    result = {"seconds": seconds, "peak_rss": peak_rss, "returncode": returncode}
+    if returncode == 0 and db_name.exists():
+        num_frames = count_frames(db_type, db_name)
+        result.update({
+            "videos_per_second": num_videos / seconds,
+            "frames": num_frames,
+            "frames_per_second": num_frames / seconds,
+            "bytes_written": get_size(db_name),
+        })
+    else:
+        result["error"] = output.decode(errors="replace")[-1000:]
+    return db_name, result
+
+
+def run_read(args, db_type, annotation_file, db_name):
+    cmd = [sys.executable, str(Path(__file__).resolve()), "read", db_type, str(annotation_file), str(db_name),
+           "--frames", str(args.frames)]
+    returncode, output, seconds, peak_rss = run_with_rusage(cmd)
+    if returncode != 0:
+        return {"returncode": returncode, "error": output.decode(errors="replace")[-1000:]}
+    result = json.loads(output.decode().splitlines()[-1])
+    result["peak_rss"] = peak_rss
+    return result
+
+
+def read(args):
+    sys.path.insert(0, str(ROOT / "examples"))
+    module_name, class_name = READERS[args.db_type]
+    dataset_type = getattr(__import__(module_name), class_name)
+
+    start = time.perf_counter()
+    dataset = dataset_type(annotation=args.annotation, database=args.database, frames=args.frames)
+    if hasattr(dataset, "__getitem__"):
+        samples = (dataset[i] for i in range(len(dataset)))
+    else:
+        samples = iter(dataset)
+    num_clips, num_frames = 0, 0
+    for video_data, _ in samples:
+        num_clips += 1
+        num_frames += len(video_data)
+    seconds = time.perf_counter() - start
+
+    print(json.dumps({
+        "seconds": seconds,
+        "clips": num_clips,
+        "clips_per_second": num_clips / seconds,
+        "frames": num_frames,
+        "frames_per_second": num_frames / seconds,
+    }))
+
+
+def get_environment():
+    def first_line(cmd):
+        try:
+            return subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, cwd=str(ROOT),
+                                  universal_newlines=True).stdout.split("\n")[0].strip()
+        except OSError:
+            return None
+
+    return {
+        "version": first_line(["git", "describe", "--always", "--dirty"]),
+        "ffmpeg": first_line(["ffmpeg", "-version"]),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def compare(results, baseline):
+    # The speed of every run, relative to the baseline
+    old_runs = {x["name"]: x for x in baseline["runs"]}
+    print("Compared with {}:".format(baseline["environment"]["version"]))
+    for run in results["runs"]:
+        if run["name"] not in old_runs:
+            continue
+        for stage, key in [("extract", "videos_per_second"), ("read", "clips_per_second")]:
+            old, new = old_runs[run["name"]].get(stage, {}).get(key), run.get(stage, {}).get(key)
+            if old and new:
+                print("  {} {} : {:.2f} -> {:.2f} {} ({:+.1%})".format(
+                    run["name"], stage, old, new, key, new / old - 1
+                ))
+
+
+def run(args):
+    work_dir = Path(args.work_dir)
+    videos = make_videos(args, work_dir / "videos")
+    annotation_file = work_dir / "benchmark.json"
+    num_videos = make_annotation(args, videos, annotation_file)
+    db_dir = work_dir / "db"
+
+    results = {
+        "environment": get_environment(),
+        "videos": [{"path": str(x), "bytes": x.stat().st_size} for x in videos],
+        "runs": [],
+    }
+    matrix = product(args.db_types.split(","), [int(x) for x in args.threads.split(",")],
+                     [int(x) for x in args.sample_modes.split(",")], [int(x) for x in args.resize_modes.split(",")])
+    for db_type, threads, sample_mode, resize_mode in matrix:
+        name = "{}-t{}-s{}-r{}".format(db_type, threads, sample_mode, resize_mode)
+        run_result = {"name": name, "db_type": db_type, "threads": threads,
+                      "sample_mode": sample_mode, "resize_mode": resize_mode}
+        if db_type == "NPY" and resize_mode != 1:
+            print("{} : Skipped, NPY needs `--resize_mode 1`".format(name))
+            continue
+
+        shutil.rmtree(str(db_dir), ignore_errors=True)
+        db_dir.mkdir(parents=True)
+        db_name, run_result["extract"] = run_extract(args, db_type, threads, sample_mode, resize_mode,
+                                                     annotation_file, db_dir, num_videos)
+        if "error" not in run_result["extract"]:
+            run_result["read"] = run_read(args, db_type, annotation_file, db_name)
+        results["runs"].append(run_result)
+
+        print("{} : extract {}, read {}".format(
+            name,
+            "{:.2f} videos/s".format(run_result["extract"]["videos_per_second"])
+            if "error" not in run_result["extract"] else "failed",
+            "{:.2f} clips/s".format(run_result["read"]["clips_per_second"])
+            if "error" not in run_result.get("read", {"error": ""}) else "failed",
+        ))
+    shutil.rmtree(str(db_dir), ignore_errors=True)
+
+    json.dump(results, Path(args.output).open("w"), indent=4)
+    print("Results saved to {}".format(args.output))
+
+    if args.baseline:
+        compare(results, json.load(Path(args.baseline).open()))
+
+
+if "__main__" == __name__:
+    args = parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        read(args)
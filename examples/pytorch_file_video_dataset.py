@@ -1,15 +1,17 @@
 import json
+import sys
 from pathlib import Path
 from random import randint
 
-import numpy as np
-from PIL import Image
 from torch.utils.data import Dataset
 from tqdm import tqdm, trange
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from reader import open_reader, uniform_index
+
 
 class FileVideoDataset(Dataset):
-    def __init__(self, annotation, database, clips=1, frames=16, transform=None):
+    def __init__(self, annotation, database, clips=1, frames=16, transform=None, size=None, cache=None):
         super().__init__()
 
         self.num_clips = clips
@@ -17,44 +19,34 @@ class FileVideoDataset(Dataset):
         self.num_frames_per_clip = frames
         assert self.num_frames_per_clip >= 0
         self.transform = transform
+        # Decode the jpgs at a lower scale, as long as the shorter side is still at least `size`
+        self.size = size
 
         data = json.load(open(annotation, "r"))
         self.n_classes = data['meta']["class_num"]
         self.annotation = data['annotation']
-        self.base_dir = Path(database)
+        # Opened on the first read in every DataLoader worker, so any `num_workers` is fine.
+        # `cache` keeps the decoded frames for the next epochs, see `reader.FrameCache`
+        self.reader = open_reader("FILE", database, cache)
         self.videos = sorted([x for x in self.annotation.keys()])
 
+    def sample_index(self, len_of_frames):
+        return uniform_index(len_of_frames, self.num_frames_per_clip)
+
     def __getitem__(self, index):
         video_id = self.videos[index]
-        video_clip_choice = "{}/{:03d}".format(video_id, randint(0, self.num_clips - 1))
-
         annotation = self.annotation[video_id]
 
-        # Sample the frames
-        len_of_frames = len(video_clip_choice.iterdir())
-        if len_of_frames != self.num_frames_per_clip > 0:
-            if self.num_frames_per_clip == 1:
-                frame_index = [len_of_frames / 2]
-            else:
-                skips = (len_of_frames - 1) * 1. / (self.num_frames_per_clip - 1)
-                frame_index = [round(fi * skips) for fi in range(self.num_frames_per_clip)]
-        else:
-            frame_index = list(range(len_of_frames))
-
-        # Decode the frames
-        frames = [
-            Image.open(
-                "{}/{:08d}.jpg".format(video_clip_choice, ith_frame)
-            ) for ith_frame in frame_index
-        ]
-
-        # To video blob
-        video_data = np.array([np.asarray(x) for x in frames])
+        # Read the uniformly sampled frames of a random clip, and decode them
+        video_data = self.reader.get_clip(video_id, randint(0, self.num_clips - 1), self.sample_index, self.size)
+
+        if self.transform:
+            video_data = self.transform(video_data)
 
         return video_data, annotation['class']
 
     def __len__(self):
-        return len(self.annotation)
+        return len(self.videos)
 
     def __repr__(self):
         return "{} {} videos, {} clips per video, {}".format(
@@ -68,13 +60,16 @@ if "__main__" == __name__:
 
     parser = argparse.ArgumentParser()
     parser.add_argument("annotation", type=str, help="The annotation file, in json format")
-    parser.add_argument("database", type=str, help="The hdf5 file")
+    parser.add_argument("database", type=str, help="The frame folder")
     parser.add_argument("--clips", type=int, default=1, help="Num of video clips")
     parser.add_argument("--frames", type=int, default=16, help="Num of frames per clip")
+    parser.add_argument("--size", type=int,
+                        help="Least shorter side of the frames, to decode the jpgs at a lower scale")
     args = parser.parse_args()
 
     dataset = FileVideoDataset(
-        annotation=args.annotation, database=args.database, clips=args.clips, frames=args.frames)
+        annotation=args.annotation, database=args.database, clips=args.clips, frames=args.frames,
+        size=args.size)
     error_index = []
     for i in trange(len(dataset)):
         try:
@@ -1,16 +1,17 @@
 import json
-from io import BytesIO
+import sys
+from pathlib import Path
 from random import randint
 
-import lmdb
-import numpy as np
-from PIL import Image
 from torch.utils.data import Dataset
 from tqdm import tqdm, trange
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from reader import open_reader, uniform_index
+
 
 class LMDBVideoDataset(Dataset):
-    def __init__(self, annotation, database, clips=1, frames=16, transform=None):
+    def __init__(self, annotation, database, clips=1, frames=16, transform=None, size=None, cache=None):
         super().__init__()
 
         self.num_clips = clips
@@ -18,32 +19,26 @@ class LMDBVideoDataset(Dataset):
         self.num_frames_per_clip = frames
         assert self.num_frames_per_clip >= 0
         self.transform = transform
+        # Decode the jpgs at a lower scale, as long as the shorter side is still at least `size`
+        self.size = size
 
         data = json.load(open(annotation, "r"))
         self.n_classes = data['meta']["class_num"]
         self.annotation = data['annotation']
-        self.database = lmdb.open(database, readonly=True).begin().cursor()
+        # Opened on the first read in every DataLoader worker, so any `num_workers` is fine.
+        # `cache` keeps the decoded frames for the next epochs, see `reader.FrameCache`
+        self.reader = open_reader("LMDB", database, cache)
         self.videos = sorted([x for x in self.annotation.keys()])
 
+    def sample_index(self, len_of_frames):
+        return uniform_index(len_of_frames, self.num_frames_per_clip)
+
     def __getitem__(self, index):
         video_id = self.videos[index]
-        video_clip_choice = "{}/{:03d}".format(video_id, randint(0, self.num_clips - 1))
-
         annotation = self.annotation[video_id]
 
-        # Decode the frames
-        frames = [
-            Image.open(
-                BytesIO(
-                    self.database.get(
-                        "{}/{:08d}".format(video_clip_choice, ith_frame).encode()
-                    )
-                )
-            ) for ith_frame in range(self.num_frames_per_clip)
-        ]
-
-        # To video blob
-        video_data = np.array([np.asarray(x) for x in frames])
+        # Read the uniformly sampled frames of a random clip, and decode them
+        video_data = self.reader.get_clip(video_id, randint(0, self.num_clips - 1), self.sample_index, self.size)
 
         if self.transform:
             video_data = self.transform(video_data)
@@ -51,11 +46,12 @@ class LMDBVideoDataset(Dataset):
         return video_data, annotation['class']
 
     def __len__(self):
-        return len(self.annotation)
+        return len(self.videos)
 
     def __repr__(self):
-        return "{} {} videos, {} clips per video, {} frames per clip".format(
-            type(self), len(self), self.num_clips, self.num_frames_per_clip
+        return "{} {} videos, {} clips per video, {}".format(
+            type(self), len(self), self.num_clips,
+            "Sample to {} frames".format(self.num_frames_per_clip) if self.num_frames_per_clip else "Not sampled"
         )
 
 
@@ -64,13 +60,16 @@ if "__main__" == __name__:
 
     parser = argparse.ArgumentParser()
     parser.add_argument("annotation", type=str, help="The annotation file, in json format")
-    parser.add_argument("database", type=str, help="The hdf5 file")
+    parser.add_argument("database", type=str, help="The lmdb folder")
     parser.add_argument("--clips", type=int, default=1, help="Num of video clips")
     parser.add_argument("--frames", type=int, default=16, help="Num of frames per clip")
+    parser.add_argument("--size", type=int,
+                        help="Least shorter side of the frames, to decode the jpgs at a lower scale")
     args = parser.parse_args()
 
     dataset = LMDBVideoDataset(
-        annotation=args.annotation, database=args.database, clips=args.clips, frames=args.frames)
+        annotation=args.annotation, database=args.database, clips=args.clips, frames=args.frames,
+        size=args.size)
     error_index = []
     for i in trange(len(dataset)):
         try:
@@ -0,0 +1,81 @@
+import json
+import sys
+from pathlib import Path
+from random import randint
+
+from torch.utils.data import Dataset
+from tqdm import tqdm, trange
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from reader import open_reader, uniform_index
+
+
+class NPYVideoDataset(Dataset):
+    def __init__(self, annotation, database, clips=1, frames=16, transform=None):
+        super().__init__()
+
+        self.num_clips = clips
+        assert self.num_clips > 0
+        self.num_frames_per_clip = frames
+        assert self.num_frames_per_clip >= 0
+        self.transform = transform
+
+        data = json.load(open(annotation, "r"))
+        self.n_classes = data['meta']["class_num"]
+        self.annotation = data['annotation']
+        # Opened on the first read in every DataLoader worker, so any `num_workers` is fine
+        self.reader = open_reader("NPY", database)
+        self.videos = sorted([x for x in self.annotation.keys()])
+
+    def sample_index(self, len_of_frames):
+        return uniform_index(len_of_frames, self.num_frames_per_clip)
+
+    def __getitem__(self, index):
+        video_id = self.videos[index]
+        annotation = self.annotation[video_id]
+
+        # Read the uniformly sampled frames of a random clip, without decoding
+        video_data = self.reader.get_clip(video_id, randint(0, self.num_clips - 1), self.sample_index)
+
+        if self.transform:
+            video_data = self.transform(video_data)
+
+        return video_data, annotation['class']
+
+    def __len__(self):
+        return len(self.videos)
+
+    def __repr__(self):
+        return "{} {} videos, {} clips per video, {}".format(
+            type(self), len(self), self.num_clips,
+            "Sample to {} frames".format(self.num_frames_per_clip) if self.num_frames_per_clip else "Not sampled"
+        )
+
+
+if "__main__" == __name__:
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("annotation", type=str, help="The annotation file, in json format")
+    parser.add_argument("database", type=str, help="The npy folder")
+    parser.add_argument("--clips", type=int, default=1, help="Num of video clips")
+    parser.add_argument("--frames", type=int, default=16, help="Num of frames per clip")
+    args = parser.parse_args()
+
+    dataset = NPYVideoDataset(
+        annotation=args.annotation, database=args.database, clips=args.clips, frames=args.frames)
+    error_index = []
+    for i in trange(len(dataset)):
+        try:
+            frame, label = dataset[i]
+            tqdm.write("Index {}, Class Label {}, Shape {}".format(i, label, frame.shape))
+        except Exception as e:
+            tqdm.write("=====> Video {} check failed".format(i))
+            error_index.append(i)
+
+    print("There are {} videos.".format(len(dataset)))
+    if not error_index:
+        print("All is well! Congratulations!")
+    else:
+        print("Ooops! There are {} bad videos:".format(len(error_index)))
+        print(error_index)
@@ -1,18 +1,24 @@
 import json
+import sys
+from pathlib import Path
 from random import random
 
-from skvideo.io import ffprobe, vread
+from skvideo.io import vread
 from torch.utils.data import Dataset
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from probe import ProbeCache, get_video_duration, get_video_meta
+
 
 class SKVideoDataset(Dataset):
-    def __init__(self, annotation, frames, duration=-1, resize="", transform=None):
+    def __init__(self, annotation, frames, duration=-1, resize="", transform=None, probe_cache=None):
         data = json.load(open(annotation, "r"))
         self.n_classes = data['meta']["class_num"]
         self.annotation = data['annotation']
         self.num_frames = frames
         self.clip_duration = duration
         self.transform = transform
+        self.probe_cache = probe_cache
         self.base_parameter = {"-vframes": "{}".format(self.num_frames)}
         if resize:
             w, h, *_ = (int(x) for x in resize.split("x")[:2])
@@ -26,8 +32,9 @@ class SKVideoDataset(Dataset):
         video_path = annotation['path']
         clazz = annotation['class']
 
-        metadata = ffprobe(video_path)
-        duration = float(metadata["video"]["@duration"])
+        cache = ProbeCache.open(self.probe_cache) if self.probe_cache else None
+        metadata = get_video_meta(video_path, cache, duration=True)
+        duration, _ = get_video_duration(video_path, metadata)
 
         output_parameter = self.base_parameter
 
@@ -54,10 +61,12 @@ if "__main__" == __name__:
     parser.add_argument("--resize", type=str, default="320x240", help="Resize the video to WxH")
     parser.add_argument("--duration", type=int, default=5, help="Seconds per clip")
     parser.add_argument("--frames", type=int, default=16, help="Num of frames per clip")
+    parser.add_argument("--probe_cache", type=str, help="The cache of probed video info, in sqlite format")
     args = parser.parse_args()
 
     dataset = SKVideoDataset(
-        annotation=args.annotation, frames=args.frames, duration=args.duration, resize=args.resize)
+        annotation=args.annotation, frames=args.frames, duration=args.duration, resize=args.resize,
+        probe_cache=args.probe_cache)
     error_index = []
 
     for i in trange(len(dataset)):
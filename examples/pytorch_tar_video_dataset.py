@@ -0,0 +1,117 @@
+import json
+import tarfile
+from io import BytesIO
+from pathlib import Path
+from random import Random, randint
+
+import numpy as np
+from PIL import Image
+from torch.utils.data import IterableDataset, get_worker_info
+from tqdm import tqdm
+
+
+class TarVideoDataset(IterableDataset):
+    # Read the shards from start to end, one by one, so that all the reads are sequential.
+    # The shards are shuffled every epoch, and shared out to the DataLoader workers.
+    def __init__(self, annotation, database, frames=16, transform=None, shuffle=True, seed=0):
+        super().__init__()
+
+        self.num_frames_per_clip = frames
+        assert self.num_frames_per_clip >= 0
+        self.transform = transform
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+        data = json.load(open(annotation, "r"))
+        self.n_classes = data['meta']["class_num"]
+        self.annotation = data['annotation']
+        self.shards = sorted(Path(database).glob("shard-*.tar"))
+        self.num_videos = sum(
+            len(set(json.load(x.with_suffix(".json").open())["videos"]) & set(self.annotation)) for x in self.shards
+        )
+
+    def set_epoch(self, epoch):
+        # Every worker gets the same shard order from the seed, and the order changes with the epoch
+        self.epoch = epoch
+
+    def __iter__(self):
+        shards = list(self.shards)
+        if self.shuffle:
+            Random(self.seed + self.epoch).shuffle(shards)
+
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            shards = shards[worker_info.id::worker_info.num_workers]
+
+        for shard in shards:
+            yield from self.read_shard(shard)
+
+    def read_shard(self, shard):
+        # One random clip per video, the frames of the other clips are skipped on the way
+        index = json.load(shard.with_suffix(".json").open())
+        clip_choice = {k: randint(0, len(v) - 1) for k, v in index["videos"].items() if k in self.annotation}
+
+        current, frames_data = None, []
+        with tarfile.open(str(shard), "r|") as tar:
+            for member in tar:
+                # The audio of the clips, at `video/audio/clip.npy`, is not used here
+                if not member.name.endswith(".jpg"):
+                    continue
+                video_id, ith_clip, _ = member.name.rsplit("/", 2)
+                if video_id != current:
+                    if frames_data:
+                        yield self.to_sample(current, frames_data)
+                    current, frames_data = video_id, []
+                if clip_choice.get(video_id) == int(ith_clip):
+                    frames_data.append(tar.extractfile(member).read())
+            if frames_data:
+                yield self.to_sample(current, frames_data)
+
+    def to_sample(self, video_id, frames_data):
+        # Sample the frames, and decode the sampled ones only
+        len_of_frames = len(frames_data)
+        if len_of_frames != self.num_frames_per_clip > 0:
+            if self.num_frames_per_clip == 1:
+                frames_data = [frames_data[len_of_frames // 2]]
+            else:
+                skips = (len_of_frames - 1) * 1. / (self.num_frames_per_clip - 1)
+                frames_data = [frames_data[round(fi * skips)] for fi in range(self.num_frames_per_clip)]
+
+        video_data = np.array([np.asarray(Image.open(BytesIO(x))) for x in frames_data])
+
+        if self.transform:
+            video_data = self.transform(video_data)
+
+        return video_data, self.annotation[video_id]['class']
+
+    def __len__(self):
+        return self.num_videos
+
+    def __repr__(self):
+        return "{} {} videos in {} shards, {}".format(
+            type(self), len(self), len(self.shards),
+            "Sample to {} frames".format(self.num_frames_per_clip) if self.num_frames_per_clip else "Not sampled"
+        )
+
+
+if "__main__" == __name__:
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("annotation", type=str, help="The annotation file, in json format")
+    parser.add_argument("database", type=str, help="The folder of tar shards")
+    parser.add_argument("--frames", type=int, default=16, help="Num of frames per clip")
+    args = parser.parse_args()
+
+    dataset = TarVideoDataset(annotation=args.annotation, database=args.database, frames=args.frames)
+    num_videos = 0
+    for frame, label in tqdm(dataset, total=len(dataset)):
+        tqdm.write("Video {}, Class Label {}, Shape {}".format(num_videos, label, frame.shape))
+        num_videos += 1
+
+    print("There are {} videos, {} read.".format(len(dataset), num_videos))
+    if num_videos == len(dataset):
+        print("All is well! Congratulations!")
+    else:
+        print("Ooops! {} videos are missing.".format(len(dataset) - num_videos))
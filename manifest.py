@@ -0,0 +1,97 @@
+import json
+from collections import Counter
+from pathlib import Path
+
+from util import failure_reason
+
+
+class Manifest:
+    # The annotation file, either a json `{"meta": ..., "annotation": {video_key: video_info}}`,
+    # or a jsonl (json lines) of one video per line `{"key": video_key, "path": ..., "class": ...}`,
+    # with an optional `{"meta": ...}` line at first.
+    # A jsonl file is read line by line every time it is iterated, so the videos are never in memory all at once.
+    def __init__(self, path):
+        self.path = str(path)
+        self.streaming = self.path.lower().endswith(".jsonl")
+        if self.streaming:
+            self.prefix, self.data = self.path[:-6], None
+            self.meta = {}
+            for video_key, meta in self.read_lines():
+                # Only the first line may be the meta
+                if video_key is None:
+                    self.meta = meta
+                break
+        else:
+            self.prefix = self.path[:-5] if self.path.lower().endswith(".json") else self.path
+            self.data = json.load(Path(self.path).open())
+            self.meta = self.data.get("meta", {})
+
+    def read_lines(self):
+        # (video_key, video_info) of the videos, or (None, meta) of the meta line
+        with Path(self.path).open() as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                video_info = json.loads(line)
+                if "key" in video_info:
+                    yield video_info.pop("key"), video_info
+                else:
+                    yield None, video_info.get("meta", {})
+
+    def __iter__(self):
+        if not self.streaming:
+            yield from self.data["annotation"].items()
+            return
+        for video_key, video_info in self.read_lines():
+            if video_key is not None:
+                yield video_key, video_info
+
+    def output_path(self, name, suffix=""):
+        # Next to the annotation file, e.g. `dataset-00003-of-00020-fix.json`
+        return self.prefix + suffix + name
+
+    def fix_path(self, suffix=""):
+        return self.output_path("-fix.jsonl" if self.streaming else "-fix.json", suffix)
+
+    def save(self, path, videos):
+        # Save the videos, an iterable of (video_key, video_info), in the same format, along with the meta
+        if self.streaming:
+            with Path(path).open("w") as f:
+                if self.meta:
+                    f.write(json.dumps({"meta": self.meta}) + "\n")
+                for video_key, video_info in videos:
+                    f.write(json.dumps({"key": video_key, **video_info}) + "\n")
+        else:
+            data = dict(self.data)
+            data["annotation"] = dict(videos)
+            json.dump(data, Path(path).open("w"), indent=4)
+
+
+class FailLog:
+    # The failed videos, each appended to a jsonl file as soon as it fails, so that they are kept even if interrupted
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.unlink(missing_ok=True)
+        self.file = None
+        self.videos = set()
+        self.reasons = Counter()
+
+    def add(self, video_key, video_path, error):
+        if self.file is None:
+            self.file = self.path.open("w")
+        reason = failure_reason(error)
+        record = {"key": video_key, "path": video_path, "reason": reason, "error": str(error)}
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        self.videos.add(video_key)
+        self.reasons[reason] += 1
+
+    def __contains__(self, video_key):
+        return video_key in self.videos
+
+    def __len__(self):
+        return len(self.videos)
+
+    def close(self):
+        if self.file:
+            self.file.close()
@@ -0,0 +1,258 @@
+import json
+import os
+import re
+import sqlite3
+import subprocess
+import threading
+from argparse import ArgumentParser
+from concurrent import futures
+
+from tqdm import tqdm
+
+from manifest import Manifest
+from util import VideoError, check_ffmpeg
+
+ffmpeg_duration_template = re.compile(r"time=\s*(\d+):(\d+):(\d+)\.(\d+)")
+
+
+def parse_frame_rate(rate):
+    num, _, den = rate.partition("/")
+    return float(num) / float(den or 1)
+
+
+def get_packet_duration(video_file, video_meta):
+    # Count the video packets without decoding them
+    cmd = [
+        "ffprobe",
+        "-v", "quiet",
+        "-select_streams", "v:0",
+        "-count_packets",
+        "-show_entries", "stream=nb_read_packets",
+        "-print_format", "json",
+        str(video_file)
+    ]
+    output = json.loads(subprocess.check_output(cmd))
+    packets = int(output["streams"][0]["nb_read_packets"])
+    return packets / parse_frame_rate(video_meta["video"]["r_frame_rate"])
+
+
+def get_decoded_duration(video_file):
+    cmd = [
+        "ffmpeg",
+        "-i", str(video_file),
+        "-f", "null", "-"
+    ]
+
+    output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+    result_all = ffmpeg_duration_template.findall(output.decode())
+    if result_all:
+        result = result_all[-1]
+        duration = float(result[0]) * 60 * 60 \
+                   + float(result[1]) * 60 \
+                   + float(result[2]) \
+                   + float(result[3]) * (10 ** -len(result[3]))
+    else:
+        duration = -1
+    return duration
+
+
+DURATION_METHODS = [
+    ("stream", lambda video_file, video_meta: float(video_meta["video"]["duration"])),
+    ("format", lambda video_file, video_meta: float(video_meta["format"]["duration"])),
+    ("frames", lambda video_file, video_meta: int(video_meta["video"]["nb_frames"])
+                                              / parse_frame_rate(video_meta["video"]["r_frame_rate"])),
+    ("packets", get_packet_duration),
+    ("decode", lambda video_file, video_meta: get_decoded_duration(video_file)),
+]
+
+
+def get_video_duration(video_file, video_meta):
+    # Try the cheap sources first, and only decode the whole video as the last resort.
+    # Returns the duration, and the method it is found by.
+    if "duration" not in video_meta:
+        video_meta["duration"] = (-1, None)
+        for method, get_duration in DURATION_METHODS:
+            try:
+                duration = get_duration(video_file, video_meta)
+            except:
+                continue
+            if duration > 0:
+                video_meta["duration"] = (duration, method)
+                break
+    return video_meta["duration"]
+
+
+def probe_video(video_file):
+    # A video which ffprobe can not read fails as in `check_ffmpeg`, e.g. "moov atom not found" is corrupt
+    cmd = [
+        "ffprobe",
+        "-v", "error",
+        "-show_streams",
+        "-show_format",
+        "-print_format", "json",
+        str(video_file)
+    ]
+    try:
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return {}
+    check_ffmpeg(proc.returncode, proc.stderr, "ffprobe", "probe")
+
+    try:
+        output = json.loads(proc.stdout)
+        streamsbytype = {}
+        for stream in output["streams"]:
+            streamsbytype[stream["codec_type"].lower()] = stream
+        streamsbytype["format"] = output.get("format", {})
+    except Exception:
+        return {}
+    return streamsbytype
+
+
+def get_video_meta(video_file, cache=None, duration=False):
+    # Probe the video, or get it from the cache. Also find the duration if asked.
+    video_meta = cache.get(video_file) if cache is not None else None
+    updated = not video_meta
+    if updated:
+        video_meta = probe_video(video_file)
+
+    if video_meta and duration and "duration" not in video_meta:
+        get_video_duration(video_file, video_meta)
+        updated = True
+
+    if video_meta and updated and cache is not None:
+        cache.put(video_file, video_meta)
+
+    return video_meta
+
+
+class ProbeCache:
+    # Probed video info in a sqlite file, keyed by the path, size and mtime of the video
+    opened = {}
+    table = "probe"
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.lock = threading.Lock()
+        self.database = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        with self.lock, self.database:
+            self.database.execute("PRAGMA journal_mode=WAL")
+            self.database.execute(
+                "CREATE TABLE IF NOT EXISTS {} (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, meta TEXT)"
+                .format(self.table)
+            )
+
+    @classmethod
+    def open(cls, path):
+        # One connection per process, shared by the threads
+        key = (cls.table, os.getpid(), str(path))
+        if key not in cls.opened:
+            cls.opened[key] = cls(path)
+        return cls.opened[key]
+
+    @staticmethod
+    def file_key(video_file):
+        stat = os.stat(str(video_file))
+        return os.path.abspath(str(video_file)), stat.st_size, stat.st_mtime
+
+    def get(self, video_file):
+        try:
+            path, size, mtime = self.file_key(video_file)
+        except OSError:
+            return None
+        with self.lock:
+            row = self.database.execute(
+                "SELECT size, mtime, meta FROM {} WHERE path = ?".format(self.table), (path,)
+            ).fetchone()
+        if row is None or row[0] != size or row[1] != mtime:
+            return None
+        return json.loads(row[2])
+
+    def put(self, video_file, video_meta):
+        path, size, mtime = self.file_key(video_file)
+        with self.lock, self.database:
+            self.database.execute("INSERT OR REPLACE INTO {} VALUES (?, ?, ?, ?)".format(self.table),
+                                  (path, size, mtime, json.dumps(video_meta)))
+
+    def invalidate(self, video_files=None, stale=False):
+        # Remove the given videos, the stale ones, or everything. Returns the num of removed entries.
+        with self.lock:
+            if video_files:
+                paths = [os.path.abspath(str(x)) for x in video_files]
+            elif stale:
+                paths = []
+                rows = self.database.execute("SELECT path, size, mtime FROM {}".format(self.table)).fetchall()
+                for path, size, mtime in rows:
+                    try:
+                        if self.file_key(path)[1:] == (size, mtime):
+                            continue
+                    except OSError:
+                        pass
+                    paths.append(path)
+            else:
+                paths = [x for x, in self.database.execute("SELECT path FROM {}".format(self.table)).fetchall()]
+            with self.database:
+                self.database.executemany("DELETE FROM {} WHERE path = ?".format(self.table), [(x,) for x in paths])
+        return len(paths)
+
+    def close(self):
+        self.database.close()
+
+
+class FailureCache(ProbeCache):
+    # The reason and error of the broken videos, keyed in the same way, so a changed video is tried again
+    table = "failure"
+
+
+def prefetch(video_files, cache, threads=8, duration=True):
+    # Probe the videos in parallel, and fill the cache. Returns the videos can not be probed.
+    fails = []
+    with futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        jobs = {executor.submit(get_video_meta, x, cache, duration): x for x in video_files}
+        for future in tqdm(futures.as_completed(jobs), total=len(jobs)):
+            try:
+                video_meta = future.result()
+            except VideoError:
+                video_meta = None
+            if not video_meta:
+                fails.append(jobs[future])
+    return fails
+
+
+def parse_args():
+    parser = ArgumentParser(description="Manage the cache of probed video info")
+    parser.add_argument("cache", type=str, help="The cache file, in sqlite format")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    prefetch_parser = subparsers.add_parser("prefetch", help="Probe the videos of annotation files into the cache")
+    prefetch_parser.add_argument("annotation_file", type=str, nargs="+",
+                                 help="The annotation files, in json or jsonl format")
+    prefetch_parser.add_argument("--threads", type=int, default=8, help="Number of threads")
+    prefetch_parser.add_argument("--no_duration", action="store_true", help="Do not find the durations")
+
+    invalidate_parser = subparsers.add_parser("invalidate", help="Remove videos from the cache, default all")
+    invalidate_parser.add_argument("video_file", type=str, nargs="*", help="The videos to remove")
+    invalidate_parser.add_argument("--stale", action="store_true",
+                                   help="Only remove the videos which are changed or missing")
+
+    return parser.parse_args()
+
+
+if "__main__" == __name__:
+    args = parse_args()
+    cache = ProbeCache(args.cache)
+
+    if args.command == "prefetch":
+        video_files = []
+        for annotation_file in args.annotation_file:
+            video_files.extend(x["path"] for _, x in Manifest(annotation_file))
+        video_files = list(dict.fromkeys(video_files))
+        fails = prefetch(video_files, cache, threads=args.threads, duration=not args.no_duration)
+        print("{} videos probed, {} failed".format(len(video_files) - len(fails), len(fails)))
+        for video_file in fails:
+            print(video_file)
+    elif args.command == "invalidate":
+        removed = cache.invalidate(args.video_file, stale=args.stale)
+        print("{} videos removed from the cache".format(removed))
+
+    cache.close()
@@ -0,0 +1,138 @@
+import json
+import resource
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+
+class NullRecord:
+    # Takes any counter, and keeps nothing
+    def __getitem__(self, key):
+        return 0
+
+    def __setitem__(self, key, value):
+        pass
+
+
+class NullTrace:
+    # Used when profiling is off, every stage is the same do-nothing context
+    record = NullRecord()
+
+    def __enter__(self):
+        return self.record
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def stage(self, name):
+        return self
+
+    def to_dict(self, status):
+        return None
+
+
+NULL_TRACE = NullTrace()
+
+
+class VideoTrace:
+    # The counters of every stage of a video, a stage may be entered more than once
+    def __init__(self, video_key):
+        self.video_key = video_key
+        self.stages = {}
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        record = self.stages.setdefault(name, Counter())
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield record
+        finally:
+            record["wall"] += time.perf_counter() - wall
+            record["cpu"] += time.thread_time() - cpu
+            record["calls"] += 1
+
+    def to_dict(self, status):
+        return {
+            "video": self.video_key,
+            "status": status,
+            "wall": time.perf_counter() - self.start,
+            "stages": {k: dict(v) for k, v in self.stages.items()},
+        }
+
+
+def add_rusage(record, rusage):
+    # The resource usage of a child process, from `wait4`
+    record["child_cpu"] += rusage.ru_utime + rusage.ru_stime
+    record["child_maxrss"] = max(record["child_maxrss"], rusage.ru_maxrss * 1024)
+    record["child_read_bytes"] += rusage.ru_inblock * 512
+    record["child_write_bytes"] += rusage.ru_oublock * 512
+
+
+class Profiler:
+    # Writes the trace of every video as a line of json, and the percentiles of every counter at last
+    percentiles = [50, 90, 99]
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.trace_file = self.path.open("w")
+        self.traces = []
+        self.start = time.perf_counter()
+
+    def add(self, trace):
+        if trace is None:
+            return
+        self.trace_file.write(json.dumps(trace) + "\n")
+        self.trace_file.flush()
+        self.traces.append(trace)
+
+    def summary(self):
+        values = defaultdict(lambda: defaultdict(list))
+        for trace in self.traces:
+            values["video"]["wall"].append(trace["wall"])
+            for name, record in trace["stages"].items():
+                for key, value in record.items():
+                    values[name][key].append(value)
+
+        stages = {}
+        for name, counters in values.items():
+            stages[name] = {}
+            for key, value in counters.items():
+                value = np.asarray(value, dtype=float)
+                stages[name][key] = {
+                    "sum": value.sum(),
+                    "mean": value.mean(),
+                    **{"p{}".format(p): v for p, v in zip(self.percentiles, np.percentile(value, self.percentiles))},
+                    "max": value.max(),
+                }
+
+        return {
+            "videos": len(self.traces),
+            "wall": time.perf_counter() - self.start,
+            "maxrss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "children_maxrss": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+            "stages": stages,
+        }
+
+    def close(self):
+        self.trace_file.close()
+        summary = self.summary()
+        if self.path.name.lower().endswith(".jsonl"):
+            summary_path = self.path.with_name(self.path.name[:-6] + "-summary.json")
+        else:
+            summary_path = self.path.with_name(self.path.name + "-summary.json")
+        json.dump(summary, summary_path.open("w"), indent=4, default=float)
+
+        # The stages sorted by the total time, with the share of the total video time
+        print("Profile of {} videos, trace saved to {}, summary saved to {}".format(
+            summary["videos"], self.path, summary_path))
+        total = summary["stages"].get("video", {}).get("wall", {}).get("sum", 0)
+        for name, counters in sorted(summary["stages"].items(), key=lambda x: -x[1]["wall"]["sum"]):
+            wall = counters["wall"]
+            print("  {:<8} {:>6.1%}  wall p50 {:.3f}s p90 {:.3f}s p99 {:.3f}s{}".format(
+                name, wall["sum"] / total if total else 0, wall["p50"], wall["p90"], wall["p99"],
+                ", ffmpeg cpu {:.1f}s".format(counters["child_cpu"]["sum"]) if "child_cpu" in counters else ""
+            ))
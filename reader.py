@@ -0,0 +1,517 @@
+import json
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from multiprocessing.managers import BaseManager
+from pathlib import Path
+
+import h5py
+import lmdb
+import numpy as np
+from PIL import Image
+
+from audio import decode_audio
+from storage import LMDBStorage, clip_length, unpack_clip
+
+
+def uniform_index(num_frames, num_samples):
+    # Uniformly sample n frames of a clip, 0 to keep all frames
+    if num_samples <= 0 or num_samples == num_frames:
+        return list(range(num_frames))
+    if num_samples == 1:
+        return [num_frames // 2]
+    skips = (num_frames - 1) * 1. / (num_samples - 1)
+    return [round(x * skips) for x in range(num_samples)]
+
+
+def resolve_index(frame_indices, num_frames):
+    # `frame_indices` is a list, a function of the clip length (e.g. `uniform_index`), or `None` for all frames
+    if frame_indices is None:
+        return list(range(num_frames))
+    if callable(frame_indices):
+        return frame_indices(num_frames)
+    return list(frame_indices)
+
+
+def draft_scale(frame_size, size):
+    # The largest of the 1/8, 1/4, 1/2 scales of the jpg decoder, which keeps the frames at least `size`
+    W, H = frame_size
+    scale = min(W // size[0], H // size[1])
+    for x in (8, 4, 2):
+        if scale >= x:
+            return x
+    return 1
+
+
+def decode_frames(frames_data, size=None, frame_size=None):
+    # With `size`, (W, H) or the shorter side, the jpgs are decoded at a lower scale in the DCT domain,
+    # as long as the frames are still at least `size`. They are to be resized to `size` after all.
+    # The `frame_size` saved at extraction tells if it is possible, before any jpg is parsed.
+    if size is not None:
+        size = (size, size) if isinstance(size, int) else tuple(size)
+        if frame_size is not None and draft_scale(frame_size, size) == 1:
+            size = None
+
+    frames = []
+    for data in frames_data:
+        image = Image.open(BytesIO(data))
+        if size is not None:
+            image.draft("RGB", size)
+        frames.append(np.asarray(image))
+    return np.array(frames)
+
+
+class FrameCache:
+    # The decoded frames by (video_key, ith_clip, ith_frame, size), evicted in LRU order beyond `max_bytes`.
+    # The length of the clips are kept too, by (video_key, ith_clip), so that a cached clip is not read at all.
+    entry_bytes = 64
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Starts empty in another process
+        return {"max_bytes": self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state["max_bytes"])
+
+    def get(self, key, count=True):
+        return self.get_many([key], count)[0]
+
+    def get_many(self, keys, count=True):
+        # All the frames of a clip at once, a single round trip for `shared_frame_cache`
+        values = []
+        with self.lock:
+            for key in keys:
+                value = self.entries.get(key)
+                if value is not None:
+                    self.entries.move_to_end(key)
+                if count:
+                    if value is None:
+                        self.misses += 1
+                    else:
+                        self.hits += 1
+                values.append(value)
+        return values
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    def put_many(self, items):
+        with self.lock:
+            for key, value in items:
+                nbytes = getattr(value, "nbytes", self.entry_bytes)
+                if nbytes > self.max_bytes:
+                    continue
+                old = self.entries.pop(key, None)
+                if old is not None:
+                    self.bytes -= getattr(old, "nbytes", self.entry_bytes)
+                self.entries[key] = value
+                self.bytes += nbytes
+                while self.bytes > self.max_bytes:
+                    _, old = self.entries.popitem(last=False)
+                    self.bytes -= getattr(old, "nbytes", self.entry_bytes)
+                    self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+class FrameCacheManager(BaseManager):
+    pass
+
+
+FrameCacheManager.register("FrameCache", FrameCache)
+
+
+def shared_frame_cache(max_bytes):
+    # A `FrameCache` in a server process, shared by all the DataLoader workers through a proxy.
+    # A lookup is a round trip to the server, which is still much cheaper than decoding a jpg.
+    manager = FrameCacheManager()
+    manager.start()
+    return manager.FrameCache(max_bytes)
+
+
+class Reader:
+    def __init__(self, path, cache=None):
+        self.path = path
+        self.cache = cache
+        self.handle = None
+        self.pid = None
+
+    @property
+    def database(self):
+        # Opened on the first read, and opened again after fork,
+        # so that every DataLoader worker has a handle of its own
+        if self.pid != os.getpid():
+            if self.handle is not None:
+                # Inherited from the parent, e.g. the dataset was read before the workers started
+                self.close_handle(self.handle)
+            self.handle = self.open()
+            self.pid = os.getpid()
+        return self.handle
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(handle=None, pid=None)
+        return state
+
+    def open(self):
+        raise NotImplementedError()
+
+    def close_handle(self, handle):
+        pass
+
+    def read_frames(self, video_key, ith_clip, frame_indices=None):
+        # The encoded frames of a clip
+        raise NotImplementedError()
+
+    def video_meta(self, video_key):
+        # Saved by `Storage.finish` along with the done mark, empty for the databases of older versions
+        raise NotImplementedError()
+
+    def read_audio(self, video_key, ith_clip):
+        # The audio of a clip, extracted by `--audio`, see `audio.decode_audio`,
+        # and `video_meta()["audio"]` for its format
+        raise NotImplementedError()
+
+    def frame_size(self, video_key):
+        frame_size = self.video_meta(video_key).get("frame_size")
+        return tuple(int(x) for x in frame_size) if frame_size is not None else None
+
+    def get_clip(self, video_key, ith_clip, frame_indices=None, size=None):
+        # The decoded frames of a clip, in a (T, H, W, 3) uint8 array, see `decode_frames` for `size`
+        frame_size = self.frame_size(video_key) if size is not None else None
+        if self.cache is not None:
+            return self.get_cached_clip(video_key, ith_clip, frame_indices, size, frame_size)
+        return decode_frames(self.read_frames(video_key, ith_clip, frame_indices), size, frame_size)
+
+    def get_cached_clip(self, video_key, ith_clip, frame_indices, size, frame_size):
+        # Only the frames missing in the cache are read and decoded
+        cache = self.cache
+        size = tuple(size) if isinstance(size, (list, tuple)) else size
+        if frame_indices is None or callable(frame_indices):
+            num_frames = cache.get((video_key, ith_clip), count=False)
+            if num_frames is not None:
+                frame_indices = resolve_index(frame_indices, num_frames)
+
+        wanted, frames, missing = [], {}, []
+
+        def find_missing(index):
+            wanted.extend(index)
+            unique_index = sorted(set(index))
+            for ith_frame, frame in zip(unique_index,
+                                        cache.get_many([(video_key, ith_clip, x, size) for x in unique_index])):
+                if frame is None:
+                    missing.append(ith_frame)
+                else:
+                    frames[ith_frame] = frame
+            return missing
+
+        if frame_indices is None or callable(frame_indices):
+            # The clip length is only known when reading
+            def resolve_missing(num_frames):
+                cache.put((video_key, ith_clip), num_frames)
+                return find_missing(resolve_index(frame_indices, num_frames))
+
+            frames_data = self.read_frames(video_key, ith_clip, resolve_missing)
+        else:
+            find_missing(list(frame_indices))
+            frames_data = self.read_frames(video_key, ith_clip, missing) if missing else []
+
+        if missing:
+            for ith_frame, frame in zip(missing, decode_frames(frames_data, size, frame_size)):
+                # A copy, rather than a view which keeps the whole clip in memory
+                frames[ith_frame] = frame.copy()
+            cache.put_many([((video_key, ith_clip, x, size), frames[x]) for x in missing])
+        return np.array([frames[ith_frame] for ith_frame in wanted])
+
+    def get_clips(self, clips, size=None):
+        # A batch of (video_key, ith_clip, frame_indices)
+        return [self.get_clip(*x, size=size) for x in clips]
+
+    def close(self):
+        if self.handle is not None:
+            self.close_handle(self.handle)
+        self.handle = None
+        self.pid = None
+
+
+class LMDBReader(Reader):
+    def open(self):
+        database = lmdb.open(self.path, readonly=True, lock=False, readahead=False)
+        with database.begin() as txn:
+            self.layout = bytes(txn.get(LMDBStorage.layout_key) or b"frame").decode()
+        return database
+
+    def read_frames(self, video_key, ith_clip, frame_indices=None, txn=None):
+        if txn is None:
+            with self.database.begin(buffers=True) as txn:
+                return self.read_frames(video_key, ith_clip, frame_indices, txn)
+
+        clip_key = "{}/{:03d}".format(video_key, ith_clip)
+        if self.layout == "clip":
+            # Only the sampled frames are copied out of the record
+            data = txn.get(clip_key.encode())
+            if data is None:
+                raise KeyError(clip_key)
+            return [bytes(x) for x in unpack_clip(data, resolve_index(frame_indices, clip_length(data)))]
+
+        if frame_indices is None or callable(frame_indices):
+            frame_indices = resolve_index(frame_indices, self.count_frames(txn, clip_key))
+        frames_data = []
+        for ith_frame in frame_indices:
+            data = txn.get("{}/{:08d}".format(clip_key, ith_frame).encode())
+            if data is None:
+                raise KeyError("{}/{:08d}".format(clip_key, ith_frame))
+            frames_data.append(bytes(data))
+        return frames_data
+
+    def read_audio(self, video_key, ith_clip):
+        audio_key = "{}/audio/{:03d}".format(video_key, ith_clip)
+        with self.database.begin(buffers=True) as txn:
+            data = txn.get(audio_key.encode())
+            if data is None:
+                raise KeyError(audio_key)
+            return decode_audio(data)
+
+    def video_meta(self, video_key, txn=None):
+        if txn is None:
+            with self.database.begin() as txn:
+                return self.video_meta(video_key, txn)
+        meta = txn.get(LMDBStorage.done_prefix + video_key.encode())
+        return json.loads(bytes(meta)) if meta else {}
+
+    def count_frames(self, txn, clip_key):
+        prefix = (clip_key + "/").encode()
+        num_frames = 0
+        cursor = txn.cursor()
+        if cursor.set_range(prefix):
+            for key in cursor.iternext(values=False):
+                if not bytes(key).startswith(prefix):
+                    break
+                num_frames += 1
+        return num_frames
+
+    def get_clips(self, clips, size=None):
+        # All the clips in a single read transaction
+        if self.cache is not None:
+            return super().get_clips(clips, size)
+        with self.database.begin(buffers=True) as txn:
+            return [
+                decode_frames(self.read_frames(*x, txn=txn), size,
+                              self.video_meta(x[0], txn).get("frame_size") if size is not None else None)
+                for x in clips
+            ]
+
+    def close_handle(self, handle):
+        handle.close()
+
+
+class HDF5Reader(Reader):
+    def open(self):
+        return h5py.File(self.path, 'r')
+
+    def read_frames(self, video_key, ith_clip, frame_indices=None):
+        clip = self.database["{}/{:03d}".format(video_key, ith_clip)]
+        frame_indices = resolve_index(frame_indices, len(clip))
+        if isinstance(clip, h5py.Dataset):
+            # The `clip` layout, read all the frames by a single call.
+            # h5py needs the index to be increasing and unique.
+            unique_index = sorted(set(frame_indices))
+            data = dict(zip(unique_index, clip[unique_index]))
+            return [data[ith_frame].tobytes() for ith_frame in frame_indices]
+        return [np.asarray(clip["{:08d}".format(ith_frame)]).tobytes() for ith_frame in frame_indices]
+
+    def read_audio(self, video_key, ith_clip):
+        return decode_audio(np.asarray(self.database["{}/audio/{:03d}".format(video_key, ith_clip)]).tobytes())
+
+    def video_meta(self, video_key):
+        video = self.database.get(video_key)
+        if video is None:
+            return {}
+        return {k: read_attr(v) for k, v in video.attrs.items() if k != "done"}
+
+    def close_handle(self, handle):
+        handle.close()
+
+
+class FileReader(Reader):
+    def open(self):
+        return Path(self.path)
+
+    def read_frames(self, video_key, ith_clip, frame_indices=None):
+        clip_dir = self.database / video_key / "{:03d}".format(ith_clip)
+        if frame_indices is None or callable(frame_indices):
+            frame_indices = resolve_index(frame_indices, len(list(clip_dir.glob("*.jpg"))))
+        return [(clip_dir / "{:08d}.jpg".format(ith_frame)).read_bytes() for ith_frame in frame_indices]
+
+    def read_audio(self, video_key, ith_clip):
+        return read_audio_file(self.database / video_key, ith_clip)
+
+    def video_meta(self, video_key):
+        return read_done(self.database / video_key)
+
+
+class PKLReader(Reader):
+    def open(self):
+        return Path(self.path)
+
+    def read_frames(self, video_key, ith_clip, frame_indices=None):
+        with (self.database / video_key / "{:03d}.pkl".format(ith_clip)).open("rb") as f:
+            frames_data = pickle.load(f)
+        return [frames_data[ith_frame] for ith_frame in resolve_index(frame_indices, len(frames_data))]
+
+    def read_audio(self, video_key, ith_clip):
+        return read_audio_file(self.database / video_key, ith_clip)
+
+    def video_meta(self, video_key):
+        return read_done(self.database / video_key)
+
+
+class NPYReader(Reader):
+    # The frames are raw uint8, nothing to decode
+    def open(self):
+        return Path(self.path)
+
+    def read_frames(self, video_key, ith_clip, frame_indices=None):
+        # A read-only memory map, only the sampled frames are read from the disk.
+        # All, contiguous or evenly strided frames (e.g. `uniform_index` of a clip long enough) are a view of the map,
+        # with no copy, other frames are copied by fancy indexing.
+        clip = np.load(str(self.database / video_key / "{:03d}.npy".format(ith_clip)), mmap_mode="r")
+        frame_indices = resolve_index(frame_indices, len(clip))
+        index = strided_slice(frame_indices)
+        return np.asarray(clip[index if index is not None else frame_indices])
+
+    def read_audio(self, video_key, ith_clip):
+        return read_audio_file(self.database / video_key, ith_clip)
+
+    def video_meta(self, video_key):
+        return read_done(self.database / video_key)
+
+    def get_clip(self, video_key, ith_clip, frame_indices=None, size=None):
+        # Already of the size given at extraction, so `size` is left to the transform.
+        # Nothing to decode, so nothing to cache either.
+        return self.read_frames(video_key, ith_clip, frame_indices)
+
+
+class TARReader(Reader):
+    # Random access by the index of every shard, the frames are read by `os.pread` so that threads can share a file
+    def open(self):
+        index = {}
+        for shard in sorted(Path(self.path).glob("shard-*.tar")):
+            shard_index = json.load(shard.with_suffix(".json").open())
+            for video_key, clips in shard_index["videos"].items():
+                index[video_key] = (shard, clips, shard_index.get("meta", {}).get(video_key, {}),
+                                    shard_index.get("audio", {}).get(video_key))
+        return index, {}
+
+    def read_frames(self, video_key, ith_clip, frame_indices=None):
+        index, files = self.database
+        shard, clips, _, _ = index[video_key]
+        frames = clips[ith_clip]
+        fd = self.shard_fd(shard)
+        return [os.pread(fd, frames[ith_frame][1], frames[ith_frame][0])
+                for ith_frame in resolve_index(frame_indices, len(frames))]
+
+    def read_audio(self, video_key, ith_clip):
+        index, _ = self.database
+        shard, _, _, audio = index[video_key]
+        if not audio or audio[ith_clip] is None:
+            raise KeyError("{}/audio/{:03d}".format(video_key, ith_clip))
+        offset, size = audio[ith_clip]
+        return decode_audio(os.pread(self.shard_fd(shard), size, offset))
+
+    def shard_fd(self, shard):
+        _, files = self.database
+        if shard not in files:
+            files[shard] = shard.open("rb")
+        return files[shard].fileno()
+
+    def video_meta(self, video_key):
+        return self.database[0][video_key][2]
+
+    def get_clips(self, clips, size=None):
+        # Read in the order of the offsets, so that the reads of a shard go forward
+        index, _ = self.database
+
+        def offset(x):
+            shard, frames, _, _ = index[x[1][0]]
+            return shard, frames[x[1][1]][0][0] if frames[x[1][1]] else 0
+
+        order = sorted(enumerate(clips), key=offset)
+        result = [None] * len(clips)
+        for ith, clip in order:
+            result[ith] = self.get_clip(*clip, size=size)
+        return result
+
+    def close_handle(self, handle):
+        for f in handle[1].values():
+            f.close()
+
+
+def read_attr(value):
+    # The HDF5 attributes back to the meta of `Storage.finish`, where a dict is saved as a json string
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, str) and value.startswith("{"):
+        return json.loads(value)
+    return value
+
+
+def strided_slice(frame_indices):
+    # The slice of an increasing index of a fixed step, or `None`
+    if not frame_indices:
+        return None
+    step = frame_indices[1] - frame_indices[0] if len(frame_indices) > 1 else 1
+    if step <= 0 or any(b - a != step for a, b in zip(frame_indices, frame_indices[1:])):
+        return None
+    return slice(frame_indices[0], frame_indices[-1] + 1, step)
+
+
+def read_audio_file(video_dir, ith_clip):
+    audio_file = video_dir / "audio" / "{:03d}.npy".format(ith_clip)
+    if not audio_file.exists():
+        raise KeyError(str(audio_file))
+    return np.load(str(audio_file))
+
+
+def read_done(video_dir):
+    # The meta in the done mark of `mark_done`
+    done_file = video_dir / ".done"
+    text = done_file.read_text() if done_file.exists() else ""
+    return json.loads(text) if text else {}
+
+
+READER_TYPES = {
+    "HDF5": HDF5Reader,
+    "LMDB": LMDBReader,
+    "FILE": FileReader,
+    "PKL": PKLReader,
+    "NPY": NPYReader,
+    "TAR": TARReader
+}
+
+
+def open_reader(db_type, path, cache=None):
+    # `cache` is a `FrameCache`, or a `shared_frame_cache` for all the DataLoader workers
+    return READER_TYPES[db_type](str(path), cache)
@@ -0,0 +1,105 @@
+import heapq
+import os
+from concurrent import futures
+
+import numpy as np
+from tqdm import tqdm
+
+from probe import ProbeCache, get_video_meta
+from util import VideoError
+
+
+def estimate_cost(args, video_meta):
+    # The pixels to decode, i.e. the seconds times the width and height, which the decoding time is roughly linear to
+    duration, _ = video_meta.get("duration", (-1, None))
+    if duration <= 0:
+        return None
+    if args.duration > 0:
+        duration = min(duration, args.clips * args.duration)
+    video = video_meta.get("video", {})
+    return duration * max(int(video.get("width", 0)) * int(video.get("height", 0)), 1)
+
+
+def probe_cost(args, video_info):
+    # Returns the cost, or None if unknown, and the file size
+    try:
+        size = os.path.getsize(video_info["path"])
+    except OSError:
+        return 0, 0
+    probe_cache = ProbeCache.open(args.probe_cache) if args.probe_cache else None
+    try:
+        video_meta = get_video_meta(video_info["path"], probe_cache, duration=True)
+    except VideoError:
+        # A broken video fails again, and quickly, when it is processed
+        video_meta = None
+    return estimate_cost(args, video_meta) if video_meta else None, size
+
+
+def simulate_makespan(costs, workers):
+    # Every job goes to the worker which is free first, as the executors do
+    finish = [0.] * workers
+    for cost in costs:
+        heapq.heappush(finish, heapq.heappop(finish) + cost)
+    return max(finish)
+
+
+class LongestFirst:
+    # Probe all the videos at first, and submit them in the order of the estimated cost, the longest first,
+    # so that a long video does not start at the end of the run and keep one worker busy while the others idle.
+    # The videos are kept in memory for the sorting, unlike the streamed annotation order.
+    def __init__(self, args, videos, workers):
+        self.workers = workers
+        videos = list(videos)
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            probed = list(tqdm(executor.map(lambda x: probe_cost(args, x[1]), videos), total=len(videos),
+                               desc="Probe"))
+
+        # The videos with unknown durations are estimated by their sizes
+        known = [(cost, size) for cost, size in probed if cost is not None]
+        cost_per_byte = sum(x for x, _ in known) / max(sum(x for _, x in known), 1)
+        self.costs = {
+            video_key: cost if cost is not None else size * cost_per_byte
+            for (video_key, _), (cost, size) in zip(videos, probed)
+        }
+        self.annotation_order = [video_key for video_key, _ in videos]
+        self.videos = sorted(videos, key=lambda x: -self.costs[x[0]])
+        self.walls = {}
+
+        predicted, annotation, lower_bound = self.predict(), self.predict(self.annotation_order), self.lower_bound()
+        print("Longest first, the predicted makespan is {:.0%} of the annotation order, {:.0%} of the lower bound"
+              .format(predicted / annotation if annotation else 1, predicted / lower_bound if lower_bound else 1))
+
+    def __iter__(self):
+        return iter(self.videos)
+
+    def __len__(self):
+        return len(self.videos)
+
+    def predict(self, order=None, seconds=None):
+        # The makespan in cost, or in seconds if a function from the cost to the seconds is given
+        costs = [self.costs[x] for x, _ in self.videos] if order is None else [self.costs[x] for x in order]
+        return simulate_makespan([seconds(x) for x in costs] if seconds else costs, self.workers)
+
+    def lower_bound(self, seconds=None):
+        # No order does better than the total cost shared by all the workers, or than the longest video
+        costs = [seconds(x) for x in self.costs.values()] if seconds else list(self.costs.values())
+        return max(sum(costs) / self.workers, max(costs, default=0))
+
+    def add(self, trace):
+        if trace is not None:
+            self.walls[trace["video"]] = trace["wall"]
+
+    def report(self, makespan):
+        # The cost is turned into seconds by a line fitted to the videos done,
+        # where the intercept is the time every video takes anyway, e.g. to probe and start ffmpeg
+        costs = [self.costs[x] for x in self.walls]
+        if len(set(costs)) < 2:
+            print("Makespan {:.1f}s, no prediction as the videos done have less than 2 distinct costs to fit".format(
+                makespan
+            ))
+            return
+        slope, intercept = np.polyfit(costs, list(self.walls.values()), 1)
+        seconds = lambda x: max(intercept + slope * x, 0)
+        print("Makespan {:.1f}s, predicted {:.1f}s (longest first), {:.1f}s (annotation order), {:.1f}s (lower bound)"
+              .format(makespan, self.predict(seconds=seconds), self.predict(self.annotation_order, seconds),
+                      self.lower_bound(seconds)))
@@ -1,5 +1,12 @@
+import json
 import pickle
 import shutil
+import signal
+import struct
+import tarfile
+import threading
+from io import BytesIO
+from queue import Empty
 from pathlib import Path
 
 import h5py
@@ -8,77 +15,481 @@ import numpy as np
 
 
 class Storage:
-    def __init__(self):
+    def __init__(self, batch_clips=1, batch_bytes=0, resume=False):
         self.database = None
+        self.resume = resume
 
-    def put(self, video_key, ith_clip, clip_tmp_dir, frame_files):
+        # Clips are collected, and committed together once the batch is full.
+        # A batch only ends after `finish`, so that a video is committed along with its done mark.
+        # The done mark carries the meta of the video, e.g. the frame size.
+        self.batch_clips = max(batch_clips, 1)
+        self.batch_bytes = batch_bytes
+        self.pending = []
+        self.pending_done = []
+        self.pending_bytes = 0
+        self.lock = threading.Lock()
+
+        # The videos of a failed batch, with the error. They may have been told OK before the batch is written.
+        self.failed = {}
+
+    def put(self, video_key, ith_clip, frames, audio=None):
+        # `audio` is the encoded audio of the clip, kept at `video/audio/clip` next to the frames
+        with self.lock:
+            self.pending.append((video_key, ith_clip, frames, audio))
+            self.pending_bytes += clip_bytes(frames, audio)
+
+    def finish(self, video_key, meta=None):
+        with self.lock:
+            # Some clips of the video are lost in a failed batch, so it is not to be marked done
+            if video_key in self.failed:
+                raise RuntimeError(self.failed[video_key])
+            self.pending_done.append((video_key, meta or {}))
+            if len(self.pending) >= self.batch_clips or 0 < self.batch_bytes <= self.pending_bytes:
+                self._flush()
+
+    def drop(self, video_key):
+        # Forget the clips of a failed video, which is never finished
+        with self.lock:
+            self.pending = [x for x in self.pending if x[0] != video_key]
+            self.pending_bytes = sum(clip_bytes(frames, audio) for _, _, frames, audio in self.pending)
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        clips, done = self.pending, self.pending_done
+        self.pending, self.pending_done, self.pending_bytes = [], [], 0
+        if clips or done:
+            try:
+                self.write(clips, done)
+            except Exception as e:
+                # A failed commit fails every video in the batch, not only the one which ends it
+                self.failed.update({x[0]: str(e) for x in clips + done})
+                raise
+
+    def write(self, clips, done):
+        raise NotImplementedError()
+
+    def done_videos(self):
         raise NotImplementedError()
 
     def close(self):
-        pass
+        self.flush()
 
 
 class LMDBStorage(Storage):
-    def __init__(self, path):
-        super().__init__()
+    # The `frame` layout keeps one record per frame at `video/clip/frame`,
+    # the `clip` layout keeps one record per clip at `video/clip`, see `pack_clip`.
+    # The audio of a clip is at `video/audio/clip` in both layouts.
+    done_prefix = b"__done__/"
+    layout_key = b"__layout__"
+
+    def __init__(self, path, layout="frame", **kwargs):
+        super().__init__(**kwargs)
         self.database = lmdb.open(path, map_size=1 << 40)
+        self.layout = layout
+        with self.database.begin(write=True) as txn:
+            stored_layout = txn.get(self.layout_key)
+            if stored_layout is None and txn.stat(self.database.open_db())["entries"]:
+                stored_layout = b"frame"
+            if stored_layout not in (None, self.layout.encode()):
+                raise RuntimeError("The database is in `{}` layout".format(stored_layout.decode()))
+            txn.put(self.layout_key, self.layout.encode())
 
-    def put(self, video_key, ith_clip, clip_tmp_dir, frame_files):
+    def write(self, clips, done):
+        # One transaction, thus one sync, for the whole batch
         with self.database.begin(write=True, buffers=True) as txn:
-            for ith_frame, (frame_id, frame_path) in enumerate(frame_files):
-                data = (clip_tmp_dir / frame_path).open("rb").read()
-                key = "{}/{:03d}/{:08d}".format(video_key, ith_clip, ith_frame)
-                txn.put(key.encode(), data)
+            for video_key, ith_clip, frames, audio in clips:
+                audio_key = "{}/audio/{:03d}".format(video_key, ith_clip).encode()
+                if audio is not None:
+                    txn.put(audio_key, audio)
+                else:
+                    txn.delete(audio_key)
+                if self.layout == "clip":
+                    key = "{}/{:03d}".format(video_key, ith_clip)
+                    txn.put(key.encode(), pack_clip(frames))
+                    continue
+                # Drop what is left by an unfinished run, which may have more frames
+                delete_prefix(txn, "{}/{:03d}/".format(video_key, ith_clip).encode())
+                for ith_frame, data in enumerate(frames):
+                    key = "{}/{:03d}/{:08d}".format(video_key, ith_clip, ith_frame)
+                    txn.put(key.encode(), data)
+            for video_key, meta in done:
+                txn.put(self.done_prefix + video_key.encode(), json.dumps(meta).encode())
+
+    def done_videos(self):
+        done = set()
+        with self.database.begin() as txn:
+            cursor = txn.cursor()
+            if cursor.set_range(self.done_prefix):
+                for key in cursor.iternext(values=False):
+                    if not key.startswith(self.done_prefix):
+                        break
+                    done.add(key[len(self.done_prefix):].decode())
+        return done
 
     def close(self):
+        super().close()
         self.database.close()
 
 
 class HDF5Storage(Storage):
-    def __init__(self, path):
-        super().__init__()
-        self.database = h5py.File(path, 'w')
+    # The `frame` layout keeps one dataset per frame at `video/clip/frame`,
+    # the `clip` layout keeps one variable-length uint8 dataset per clip at `video/clip`.
+    # The audio of a clip is a dataset at `video/audio/clip` in both layouts.
+    def __init__(self, path, layout="frame", compression=None, chunk_frames=64, **kwargs):
+        super().__init__(**kwargs)
+        self.database = h5py.File(path, 'a' if self.resume else 'w')
+        self.layout = layout
+        self.compression = compression
+        self.chunk_frames = max(chunk_frames, 1)
+        if len(self.database) and self.database.attrs.get("layout", "frame") != self.layout:
+            raise RuntimeError(
+                "Can not resume a database in `{}` layout".format(self.database.attrs.get("layout", "frame"))
+            )
+        self.database.attrs["layout"] = self.layout
+
+    def write(self, clips, done):
+        for video_key, ith_clip, frames, audio in clips:
+            # Drop what is left by an unfinished run
+            clip_key = "{}/{:03d}".format(video_key, ith_clip)
+            audio_key = "{}/audio/{:03d}".format(video_key, ith_clip)
+            for key in (clip_key, audio_key):
+                if key in self.database:
+                    del self.database[key]
+            if audio is not None:
+                self.database[audio_key] = np.void(audio)
+            if self.layout == "clip":
+                self.write_clip(clip_key, frames)
+            else:
+                for ith_frame, data in enumerate(frames):
+                    key = "{}/{:08d}".format(clip_key, ith_frame)
+                    self.database[key] = np.void(data)
+        for video_key, meta in done:
+            video = self.database.require_group(video_key)
+            # The attributes can not be nested, so a dict (e.g. the audio format) is kept as a json string
+            video.attrs.update({k: json.dumps(v) if isinstance(v, dict) else v for k, v in meta.items()})
+            video.attrs["done"] = True
+        self.database.flush()
 
-    def put(self, video_key, ith_clip, clip_tmp_dir, frame_files):
-        for ith_frame, (frame_id, frame_path) in enumerate(frame_files):
-            data = (clip_tmp_dir / frame_path).open("rb").read()
-            key = "{}/{:03d}/{:08d}".format(video_key, ith_clip, ith_frame)
-            self.database[key] = np.void(data)
+    def write_clip(self, clip_key, frames):
+        data = np.empty(len(frames), dtype=object)
+        for ith_frame, frame in enumerate(frames):
+            data[ith_frame] = np.frombuffer(frame, dtype=np.uint8)
+        self.database.create_dataset(
+            clip_key, data=data, dtype=h5py.vlen_dtype(np.uint8),
+            chunks=(max(min(len(frames), self.chunk_frames), 1),), compression=self.compression
+        )
+
+    def done_videos(self):
+        return {k for k, v in self.database.items() if v.attrs.get("done", False)}
 
     def close(self):
+        super().close()
         self.database.close()
 
 
 class PKLStorage(Storage):
-    def __init__(self, path):
-        super().__init__()
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
         self.base_path = Path(path)
 
-    def put(self, video_key, ith_clip, clip_tmp_dir, frame_files):
-        save_dir = self.base_path / video_key
-        save_dir.mkdir(exist_ok=True, parents=True)
-        frame_data = []
-        for ith_frame, (frame_id, frame_path) in enumerate(frame_files):
-            data = (clip_tmp_dir / frame_path).open("rb").read()
-            frame_data.append(data)
-        pickle.dump(frame_data, (save_dir / "{:03d}.pkl".format(ith_clip)).open("wb"))
+    def write(self, clips, done):
+        for video_key, ith_clip, frames, audio in clips:
+            save_dir = self.base_path / video_key
+            save_dir.mkdir(exist_ok=True, parents=True)
+            save_audio(save_dir, ith_clip, audio)
+            pickle.dump(list(frames), (save_dir / "{:03d}.pkl".format(ith_clip)).open("wb"))
+        for video_key, meta in done:
+            mark_done(self.base_path / video_key, meta)
+
+    def done_videos(self):
+        return find_done(self.base_path)
 
 
 class FileStorage(Storage):
-    def __init__(self, path):
-        super().__init__()
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.base_path = Path(path)
+
+    def write(self, clips, done):
+        for video_key, ith_clip, frames, audio in clips:
+            # Drop what is left by an unfinished run, which may have more frames
+            save_dir = self.base_path / video_key / "{:03d}".format(ith_clip)
+            shutil.rmtree(save_dir, ignore_errors=True)
+            save_dir.mkdir(parents=True)
+            save_audio(save_dir.parent, ith_clip, audio)
+            for ith_frame, data in enumerate(frames):
+                (save_dir / "{:08d}.jpg".format(ith_frame)).write_bytes(data)
+        for video_key, meta in done:
+            mark_done(self.base_path / video_key, meta)
+
+    def done_videos(self):
+        return find_done(self.base_path)
+
+
+class NPYStorage(Storage):
+    # Raw uint8 frames, one (T, H, W, 3) array per clip, to be read by `np.load(mmap_mode='r')`
+    def __init__(self, path, frame_size, **kwargs):
+        super().__init__(**kwargs)
+        self.base_path = Path(path)
+        self.frame_size = tuple(frame_size)
+
+    def write(self, clips, done):
+        W, H = self.frame_size
+        for video_key, ith_clip, frames, audio in clips:
+            save_dir = self.base_path / video_key
+            save_dir.mkdir(exist_ok=True, parents=True)
+            save_audio(save_dir, ith_clip, audio)
+            data = np.frombuffer(b"".join(frames), dtype=np.uint8).reshape(len(frames), H, W, 3)
+            save_path = save_dir / "{:03d}.npy".format(ith_clip)
+            with save_path.with_suffix(".tmp").open("wb") as f:
+                np.save(f, data)
+            save_path.with_suffix(".tmp").replace(save_path)
+        for video_key, meta in done:
+            mark_done(self.base_path / video_key, meta)
+
+    def done_videos(self):
+        return find_done(self.base_path)
+
+
+class TARStorage(Storage):
+    # Size-bounded tar shards, `shard-000000.tar` with the members at `video/clip/frame.jpg`,
+    # and an index `shard-000000.json` of the (offset, size) of every frame in the shard.
+    # The audio of a clip is at `video/audio/clip.npy`, indexed by the (offset, size) of every clip, or `null`.
+    # The clips of a video are held back until it is finished, so that a shard only has whole videos.
+    # A shard is written as `.tar.tmp`, and renamed once it is full and indexed.
+    def __init__(self, path, shard_size=1 << 30, **kwargs):
+        super().__init__(**kwargs)
         self.base_path = Path(path)
+        self.base_path.mkdir(exist_ok=True, parents=True)
+        self.shard_size = shard_size
+        self.holding = {}
+
+        for tmp_file in self.base_path.glob("shard-*.tar.tmp"):
+            tmp_file.unlink()
+        if not self.resume:
+            for shard_file in self.base_path.glob("shard-*.*"):
+                shard_file.unlink()
+        self.num_shards = len(list(self.base_path.glob("shard-*.tar")))
+
+        self.shard_path = None
+        self.database = None
+        self.index = None
+
+    def write(self, clips, done):
+        for video_key, ith_clip, frames, audio in clips:
+            self.holding.setdefault(video_key, []).append((ith_clip, frames, audio))
+        for video_key, meta in done:
+            video_clips = sorted(self.holding.pop(video_key, []), key=lambda x: x[0])
+            video_bytes = sum(member_size(x) for _, frames, _ in video_clips for x in frames)
+            video_bytes += sum(member_size(audio) for _, _, audio in video_clips if audio is not None)
+            if self.database and tar_size(self.database.offset + video_bytes) > self.shard_size:
+                self.close_shard()
+            if not self.database:
+                self.open_shard()
+            self.index["videos"][video_key] = [self.write_clip(video_key, ith_clip, frames)
+                                               for ith_clip, frames, _ in video_clips]
+            if any(audio is not None for _, _, audio in video_clips):
+                self.index["audio"][video_key] = [
+                    self.add_member("{}/audio/{:03d}.npy".format(video_key, ith_clip), audio)
+                    if audio is not None else None
+                    for ith_clip, _, audio in video_clips
+                ]
+            self.index["meta"][video_key] = meta
+
+    def write_clip(self, video_key, ith_clip, frames):
+        return [self.add_member("{}/{:03d}/{:08d}.jpg".format(video_key, ith_clip, ith_frame), data)
+                for ith_frame, data in enumerate(frames)]
+
+    def add_member(self, name, data):
+        # Fixed metadata, so that the same frames always give the same shard.
+        # Returns the (offset, size) of the data in the shard.
+        info = tarfile.TarInfo(name)
+        info.size, info.mode, info.mtime = len(data), 0o644, 0
+        self.database.addfile(info, BytesIO(data))
+        padded_size = (len(data) + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+        return self.database.offset - padded_size, len(data)
+
+    def drop(self, video_key):
+        super().drop(video_key)
+        with self.lock:
+            self.holding.pop(video_key, None)
+
+    def open_shard(self):
+        self.shard_path = self.base_path / "shard-{:06d}.tar".format(self.num_shards)
+        self.database = tarfile.open(str(self.shard_path) + ".tmp", "w")
+        self.index = {"videos": {}, "meta": {}, "audio": {}}
+        self.num_shards += 1
+
+    def close_shard(self):
+        self.database.close()
+        json.dump(self.index, self.shard_path.with_suffix(".json").open("w"))
+        Path(str(self.shard_path) + ".tmp").replace(self.shard_path)
+        self.database = None
+
+    def done_videos(self):
+        done = set()
+        for index_file in self.base_path.glob("shard-*.json"):
+            if index_file.with_suffix(".tar").exists():
+                done.update(json.load(index_file.open())["videos"])
+        return done
+
+    def close(self):
+        # The unfinished videos are dropped, and will be done again by `--resume`
+        super().close()
+        if self.database:
+            self.close_shard()
+
+
+def clip_bytes(frames, audio=None):
+    return sum(len(x) for x in frames) + len(audio or b"")
+
+
+def member_size(data):
+    # The bytes of a member in a tar file, a header block and the data padded to whole blocks
+    return tarfile.BLOCKSIZE + (len(data) + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+
+
+def tar_size(offset):
+    # The bytes of a tar file closed at `offset`, with the two end blocks, padded to whole records
+    return (offset + 2 * tarfile.BLOCKSIZE + tarfile.RECORDSIZE - 1) // tarfile.RECORDSIZE * tarfile.RECORDSIZE
+
+
+def pack_clip(frames):
+    # A header of the frame count and the (count + 1) frame offsets, followed by the concatenated frames
+    header_size = 4 + 8 * (len(frames) + 1)
+    offsets = [header_size]
+    for frame in frames:
+        offsets.append(offsets[-1] + len(frame))
+    return b"".join([struct.pack("<I{}Q".format(len(offsets)), len(frames), *offsets), *frames])
+
+
+def unpack_clip(data, frame_index=None):
+    # Slice the frames out of a packed clip. With a memoryview, the frames are memoryviews too.
+    num_frames, = struct.unpack_from("<I", data, 0)
+    offsets = struct.unpack_from("<{}Q".format(num_frames + 1), data, 4)
+    if frame_index is None:
+        frame_index = range(num_frames)
+    return [data[offsets[i]:offsets[i + 1]] for i in frame_index]
+
+
+def clip_length(data):
+    return struct.unpack_from("<I", data, 0)[0]
+
+
+def delete_prefix(txn, prefix):
+    cursor = txn.cursor()
+    if cursor.set_range(prefix):
+        while bytes(cursor.key()).startswith(prefix):
+            if not cursor.delete():
+                break
+
+
+def save_audio(video_dir, ith_clip, audio):
+    # The audio of the clips of a video are in `video/audio/clip.npy`
+    audio_file = video_dir / "audio" / "{:03d}.npy".format(ith_clip)
+    if audio is None:
+        audio_file.unlink(missing_ok=True)
+        return
+    audio_file.parent.mkdir(exist_ok=True, parents=True)
+    audio_file.write_bytes(audio)
+
+
+def mark_done(video_dir, meta=None):
+    video_dir.mkdir(exist_ok=True, parents=True)
+    (video_dir / ".done").write_text(json.dumps(meta or {}))
+
+
+def find_done(base_path):
+    if not base_path.exists():
+        return set()
+    return {x.name for x in base_path.iterdir() if (x / ".done").exists()}
+
+
+class QueueStorage(Storage):
+    # Forward the clips to `storage_writer` in another process
+    def __init__(self, queue):
+        super().__init__()
+        self.database = queue
+
+    def put(self, video_key, ith_clip, frames, audio=None):
+        self.database.put(("put", (video_key, ith_clip, frames, audio)))
+
+    def finish(self, video_key, meta=None):
+        self.database.put(("finish", (video_key, meta)))
+
+    def drop(self, video_key):
+        self.database.put(("drop", (video_key,)))
+
+
+def storage_writer(db_type, path, queue, fails, storage_setting):
+    # Owns the database, and writes the clips from `QueueStorage` until it gets `None`.
+    # Ctrl-C is left to the main process, which stops feeding the queue and then sends `None`.
+    # Always tells the main process the (path, failed videos, error) at last, see `collect_writers`.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    try:
+        frame_db = STORAGE_TYPES[db_type](path, **storage_setting)
+    except Exception as e:
+        fails.put((path, [], str(e)))
+        raise
+    for method, params in iter(queue.get, None):
+        try:
+            getattr(frame_db, method)(*params)
+        except Exception as e:
+            frame_db.failed.setdefault(params[0], str(e))
+    try:
+        frame_db.close()
+    except Exception:
+        pass
+    fails.put((path, list(frame_db.failed.items()), None))
+
+
+def writers_gone(writers):
+    # The writers only exit after `None`, so an exited one has failed, e.g. killed for out of memory
+    return [x for x in writers if x.exitcode is not None]
+
+
+def discard(queue):
+    # Take the clips for a writer which is gone, so that the workers putting them are not blocked forever
+    while True:
+        queue.get()
+
+
+def collect_writers(writers, queues, fails):
+    # Stop the writers, and return the failed videos and the errors of the writers.
+    # A writer which is gone without telling is only waited for until all the writers are gone.
+    for writer, queue in zip(writers, queues):
+        if writer.exitcode is None:
+            queue.put(None)
+    results = {}
+    while len(results) < len(writers):
+        try:
+            path, failed, error = fails.get(timeout=1)
+        except Empty:
+            if len(writers_gone(writers)) == len(writers):
+                break
+            continue
+        results[path] = (failed, error)
+    for writer in writers:
+        writer.join()
 
-    def put(self, video_key, ith_clip, clip_tmp_dir, frame_files):
-        save_dir = self.base_path / video_key / "{:03d}".format(ith_clip)
-        save_dir.mkdir(exist_ok=True, parents=True)
-        for ith_frame, (frame_id, frame_path) in enumerate(frame_files):
-            shutil.copy(str((clip_tmp_dir / frame_path)), str(save_dir / "{:08d}.jpg".format(ith_frame)))
+    failed, errors = [], []
+    for writer in writers:
+        writer_failed, error = results.get(writer.name, ([], "exited with code {}".format(writer.exitcode)))
+        failed.extend(writer_failed)
+        if error:
+            errors.append("The storage writer of {} failed: {}".format(writer.name, error))
+    return failed, errors
 
 
 STORAGE_TYPES = {
     "HDF5": HDF5Storage,
     "LMDB": LMDBStorage,
     "FILE": FileStorage,
-    "PKL": PKLStorage
+    "PKL": PKLStorage,
+    "NPY": NPYStorage,
+    "TAR": TARStorage
 }
@@ -0,0 +1,41 @@
+import pytest
+
+from storage import FileStorage
+
+
+class FailingStorage(FileStorage):
+    # Fails after the first clip of a batch is written
+    def write(self, clips, done):
+        super().write(clips[:1], [])
+        raise OSError("No space left on device")
+
+
+def test_failed_batch_fails_every_video(tmp_path):
+    frame_db = FailingStorage(str(tmp_path), batch_clips=3)
+    for video_key in ("A", "B"):
+        frame_db.put(video_key, 0, [b"frame"])
+        frame_db.finish(video_key)
+
+    # The batch is written, and fails, at the 3rd video
+    frame_db.put("C", 0, [b"frame"])
+    with pytest.raises(OSError):
+        frame_db.finish("C")
+
+    assert set(frame_db.failed) == {"A", "B", "C"}
+    assert frame_db.done_videos() == set()
+    assert not frame_db.pending and not frame_db.pending_done
+
+
+def test_failed_video_is_not_marked_done(tmp_path):
+    frame_db = FailingStorage(str(tmp_path), batch_clips=2)
+    frame_db.put("A", 0, [b"frame"])
+    frame_db.put("B", 0, [b"frame"])
+    with pytest.raises(OSError):
+        frame_db.finish("A")
+
+    # A clip of B is lost with the batch of A
+    frame_db.put("B", 1, [b"frame"])
+    with pytest.raises(RuntimeError):
+        frame_db.finish("B")
+    assert "B" in frame_db.failed
+    assert not frame_db.pending_done
@@ -0,0 +1,55 @@
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+import h5py
+import numpy as np
+from tqdm import tqdm
+
+
+def parse_args():
+    description = """
+    This is a converter from the HDF5 `frame` layout (one dataset per frame, at `video/clip/frame`)
+    to the HDF5 `clip` layout (one variable-length uint8 dataset per clip, at `video/clip`).
+    The audio of the clips (at `video/audio/clip`) is the same in both layouts, and copied as it is.
+
+    You should provide the path of the old database, and the path of the new one.
+    """
+    parser = ArgumentParser(description=description, formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("source", type=str, help="The hdf5 file in `frame` layout")
+    parser.add_argument("output", type=str, help="The hdf5 file in `clip` layout")
+    parser.add_argument("--compression", type=str, choices=["gzip", "lzf"], help="Compression of the new file")
+    parser.add_argument("--chunk", type=int, default=64, help="Frames per chunk")
+    return parser.parse_args()
+
+
+if "__main__" == __name__:
+    args = parse_args()
+
+    source = h5py.File(args.source, 'r')
+    assert source.attrs.get("layout", "frame") == "frame", "The source file is not in `frame` layout"
+    output = h5py.File(args.output, 'w')
+    output.attrs["layout"] = "clip"
+
+    num_videos, num_clips = len(source), 0
+    for video_key, video in tqdm(source.items(), total=len(source)):
+        for clip_key, clip in video.items():
+            if clip_key == "audio":
+                source.copy(clip, output.require_group(video_key), name=clip_key)
+                continue
+            frame_keys = sorted(clip.keys())
+            data = np.empty(len(frame_keys), dtype=object)
+            for ith_frame, frame_key in enumerate(frame_keys):
+                data[ith_frame] = np.frombuffer(np.asarray(clip[frame_key]).tobytes(), dtype=np.uint8)
+
+            output.create_dataset(
+                "{}/{}".format(video_key, clip_key), data=data, dtype=h5py.vlen_dtype(np.uint8),
+                chunks=(max(min(len(frame_keys), args.chunk), 1),), compression=args.compression
+            )
+            num_clips += 1
+
+        output.require_group(video_key).attrs.update(video.attrs)
+
+    source.close()
+    output.close()
+
+    print("{} videos, {} clips".format(num_videos, num_clips))
+    print("Done")
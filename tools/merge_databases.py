@@ -0,0 +1,203 @@
+import heapq
+import shutil
+import sys
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from pathlib import Path
+
+import h5py
+import lmdb
+from tqdm import tqdm
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from manifest import Manifest
+from storage import LMDBStorage
+from util import shard_of, shard_suffix
+
+
+def parse_args():
+    description = """
+    This is a tool to merge the databases of the shards (`--num_shards` / `--shard_index`) into one.
+
+    You should provide the path of the new database, and the paths of the shard databases, e.g.
+        python tools/merge_databases.py dataset.lmdb dataset-*-of-00004.lmdb
+    The fix files (and the logs of the failed videos) of the shards are merged too, if the annotation file is given.
+    """
+    parser = ArgumentParser(description=description, formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("output", type=str, help="The new database, which must not exist yet")
+    parser.add_argument("sources", type=str, nargs="+", help="The shard databases")
+    parser.add_argument("--db_type", type=str, choices=["LMDB", "HDF5", "FILE", "PKL", "NPY", "TAR"],
+                        help="Type of the databases, guessed from the extension of the output by default")
+    parser.add_argument("--move", action="store_true",
+                        help="Move the videos rather than copy them, for FILE, PKL, NPY and TAR databases")
+    parser.add_argument("--batch_bytes", type=int, default=1 << 30, help="Bytes per transaction of LMDB")
+    parser.add_argument("--annotation", type=str, help="The annotation file, to merge the `*-fix.json` of the shards")
+    parser.add_argument("--num_shards", type=int, help="Num of shards, default is the num of source databases")
+    args = parser.parse_args()
+
+    if not args.db_type:
+        if args.output.lower().endswith(".lmdb"):
+            args.db_type = "LMDB"
+        elif args.output.lower().endswith(".hdf5"):
+            args.db_type = "HDF5"
+        else:
+            parser.error("Can not guess the type of the database, please set `--db_type`")
+    if not args.num_shards:
+        args.num_shards = len(args.sources)
+
+    return args
+
+
+def merge_lmdb(sources, output, batch_bytes):
+    # The keys of every shard come sorted, so a k-way merge of them is sorted too,
+    # and can be appended to the end of the new database without searching the tree
+    envs = [lmdb.open(x, readonly=True, lock=False, readahead=False) for x in sources]
+    layouts = set()
+    for env in envs:
+        with env.begin() as txn:
+            layouts.add(txn.get(LMDBStorage.layout_key, b"frame"))
+    if len(layouts) > 1:
+        raise RuntimeError("The databases are in different layouts: {}".format(b", ".join(layouts).decode()))
+
+    txns = [env.begin() for env in envs]
+    database = lmdb.open(output, map_size=1 << 40)
+    txn = database.begin(write=True)
+    num_records, num_bytes, last_key = 0, 0, None
+    try:
+        for key, value in tqdm(heapq.merge(*[x.cursor().iternext() for x in txns]), unit=" records"):
+            if key == last_key:
+                if key == LMDBStorage.layout_key:
+                    continue
+                raise RuntimeError("{} is in more than one database".format(key.decode()))
+            txn.put(key, value, append=True)
+            last_key = key
+            num_records += 1
+            num_bytes += len(key) + len(value)
+            if num_bytes >= batch_bytes:
+                txn.commit()
+                txn = database.begin(write=True)
+                num_bytes = 0
+        txn.commit()
+    except BaseException:
+        txn.abort()
+        raise
+    finally:
+        for x in txns:
+            x.abort()
+        for env in envs:
+            env.close()
+        database.close()
+
+    print("{} records".format(num_records))
+
+
+def merge_hdf5(sources, output):
+    # `copy` clones a whole video group, along with its attributes, without decoding the datasets
+    databases = [h5py.File(x, "r") for x in sources]
+    layouts = {x.attrs.get("layout", "frame") for x in databases}
+    if len(layouts) > 1:
+        raise RuntimeError("The databases are in different layouts: {}".format(", ".join(layouts)))
+
+    database = h5py.File(output, "w")
+    database.attrs["layout"] = layouts.pop() if layouts else "frame"
+    num_videos = 0
+    try:
+        for source in databases:
+            for video_key in tqdm(source.keys(), total=len(source), desc=source.filename):
+                if video_key in database:
+                    raise RuntimeError("{} is in more than one database".format(video_key))
+                source.copy(source[video_key], database, name=video_key)
+                num_videos += 1
+    finally:
+        for source in databases:
+            source.close()
+        database.close()
+
+    print("{} videos".format(num_videos))
+
+
+def merge_folders(sources, output, move):
+    # One folder per video, so the folders are copied (or moved) as they are
+    output.mkdir(parents=True)
+    num_videos = 0
+    for source in sources:
+        for video_dir in tqdm(sorted(Path(source).iterdir()), desc=source):
+            target = output / video_dir.name
+            if target.exists():
+                raise RuntimeError("{} is in more than one database".format(video_dir.name))
+            if move:
+                shutil.move(str(video_dir), str(target))
+            else:
+                shutil.copytree(str(video_dir), str(target))
+            num_videos += 1
+
+    print("{} videos".format(num_videos))
+
+
+def merge_tar(sources, output, move):
+    # The shards are renumbered, every shard keeps its own index
+    output.mkdir(parents=True)
+    num_shards = 0
+    for source in sources:
+        for shard in tqdm(sorted(Path(source).glob("shard-*.tar")), desc=source):
+            index = shard.with_suffix(".json")
+            if not index.exists():
+                continue
+            target = output / "shard-{:06d}.tar".format(num_shards)
+            if move:
+                shutil.move(str(index), str(target.with_suffix(".json")))
+                shutil.move(str(shard), str(target))
+            else:
+                shutil.copyfile(str(index), str(target.with_suffix(".json")))
+                shutil.copyfile(str(shard), str(target))
+            num_shards += 1
+
+    print("{} shards".format(num_shards))
+
+
+def merge_fix(annotation_file, num_shards):
+    # A shard without a fix file has no failed video, so all its videos are kept.
+    # The failed videos logged by the shards are put together as well.
+    manifest = Manifest(annotation_file)
+    suffixes = [shard_suffix(x, num_shards) for x in range(num_shards)]
+
+    def merged_videos():
+        for shard_index, suffix in enumerate(suffixes):
+            fix_path = Path(manifest.fix_path(suffix))
+            if fix_path.exists():
+                yield from Manifest(fix_path)
+            else:
+                yield from ((k, v) for k, v in manifest if shard_of(k, num_shards) == shard_index)
+
+    fixed = [x for x in suffixes if Path(manifest.fix_path(x)).exists()]
+    if not fixed:
+        print("No failed video")
+        return
+
+    print("{} of {} shards have failed videos".format(len(fixed), num_shards))
+    manifest.save(manifest.fix_path(), merged_videos())
+    with Path(manifest.output_path("-fails.jsonl")).open("w") as f:
+        for suffix in fixed:
+            fail_path = Path(manifest.output_path("-fails.jsonl", suffix))
+            if fail_path.exists():
+                f.write(fail_path.read_text())
+
+
+if "__main__" == __name__:
+    args = parse_args()
+
+    output = Path(args.output)
+    assert not output.exists(), "{} exists".format(output)
+
+    if args.db_type == "LMDB":
+        merge_lmdb(args.sources, args.output, args.batch_bytes)
+    elif args.db_type == "HDF5":
+        merge_hdf5(args.sources, args.output)
+    elif args.db_type == "TAR":
+        merge_tar(args.sources, output, args.move)
+    else:
+        merge_folders(args.sources, output, args.move)
+
+    if args.annotation:
+        merge_fix(args.annotation, args.num_shards)
+
+    print("Done")
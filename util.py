@@ -1,11 +1,64 @@
 import argparse
+import errno
+import hashlib
+import json
 import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
+from pathlib import Path
 
 from easydict import EasyDict
 
 
-def retry(tries=5):
+class VideoError(RuntimeError):
+    # A failed video, with the reason of the failure, and whether it may succeed if tried again
+    def __init__(self, message, reason="error", transient=False):
+        super().__init__(message)
+        self.reason = reason
+        self.transient = transient
+
+    def __reduce__(self):
+        # Keep the reason when sent back from a worker process
+        return type(self), (str(self), self.reason, self.transient), self.__dict__
+
+
+# The errors of the machine, which may be gone in a while, unlike e.g. a missing file or binary
+TRANSIENT_ERRNOS = {errno.EAGAIN, errno.ENOMEM, errno.EIO, errno.EINTR, errno.EBUSY, errno.ENFILE, errno.EMFILE,
+                    errno.ENOSPC, errno.ETIMEDOUT, errno.ECONNRESET, errno.ESTALE}
+
+
+def is_transient(e):
+    if isinstance(e, VideoError):
+        return e.transient
+    if isinstance(e, OSError):
+        return e.errno in TRANSIENT_ERRNOS
+    return isinstance(e, MemoryError)
+
+
+# The failures of the video itself, which fail the same way every time.
+# Not "empty_sample", no frame in a window or a sample, which depends on the options.
+BROKEN_REASONS = ["corrupt", "codec", "empty"]
+
+
+def is_broken(e):
+    return isinstance(e, VideoError) and not e.transient and e.reason in BROKEN_REASONS
+
+
+def failure_reason(e):
+    if isinstance(e, VideoError):
+        return e.reason
+    if isinstance(e, OSError):
+        return "io"
+    if isinstance(e, MemoryError):
+        return "memory"
+    return "error"
+
+
+def retry(tries=5, backoff=0.):
+    # Only the transient errors are tried again, after `backoff` seconds, doubled every time (at most a minute).
+    # A broken video fails the same way every time, so it fails at once.
     def deco_retry(f):
         @wraps(f)
         def f_retry(*args, **kwargs):
@@ -13,8 +66,11 @@ def retry(tries=5):
             while mtries > 1:
                 try:
                     return f(*args, **kwargs)
-                except:
+                except Exception as e:
+                    if not is_transient(e):
+                        raise
                     mtries -= 1
+                    time.sleep(min(backoff * 2 ** (tries - mtries - 1), 60))
             return f(*args, **kwargs)
 
         return f_retry  # true decorator
@@ -22,6 +78,158 @@ def retry(tries=5):
     return deco_retry
 
 
+# The ffmpeg errors of broken videos, which are the same however many times tried
+FFMPEG_ERRORS = [
+    ("moov atom not found", "corrupt"),
+    ("invalid data found when processing input", "corrupt"),
+    ("could not find codec parameters", "corrupt"),
+    ("decoder (codec", "codec"),
+    ("no decoder found", "codec"),
+    ("unknown decoder", "codec"),
+]
+
+# The ffmpeg errors of the machine, rather than of the video
+FFMPEG_TRANSIENT_ERRORS = [
+    ("input/output error", "io"),
+    ("cannot allocate memory", "memory"),
+    ("resource temporarily unavailable", "io"),
+    ("connection reset", "io"),
+    ("connection timed out", "io"),
+]
+
+
+def check_ffmpeg(returncode, stderr, program="ffmpeg", reason="ffmpeg"):
+    # Raises a `VideoError` if ffmpeg (or ffprobe) failed, e.g. a signal from the OOM killer is transient,
+    # and an exit code is deterministic unless the error is known to be transient.
+    # `reason` is for the exit codes of unknown errors.
+    if returncode == 0:
+        return
+    if returncode < 0:
+        raise VideoError("{} killed by signal {}".format(program, -returncode), "killed", transient=True)
+
+    lines = stderr.decode(errors="replace").strip().splitlines()
+    message = "{} exited with {}: {}".format(program, returncode, lines[-1] if lines else "no error message")
+    for pattern, error_reason in FFMPEG_TRANSIENT_ERRORS:
+        if any(pattern in x.lower() for x in lines):
+            raise VideoError(message, error_reason, transient=True)
+    for pattern, error_reason in FFMPEG_ERRORS:
+        if any(pattern in x.lower() for x in lines):
+            raise VideoError(message, error_reason)
+    raise VideoError(message, reason)
+
+
+def read_pipes(pipes):
+    # Read all the pipes at the same time, so that the child is never blocked on a full one
+    files = [os.fdopen(r, "rb") for r, _ in pipes]
+    try:
+        with ThreadPoolExecutor(max_workers=len(files)) as executor:
+            return list(executor.map(lambda f: f.read(), files))
+    finally:
+        for f in files:
+            f.close()
+
+
+def run_command(cmd, stdout=None, stderr=None, pipes=()):
+    # Like `subprocess.run`, but reaps the child by `wait4` to get its resource usage.
+    # `pipes` are extra (read, write) pipes from `os.pipe`, the write ends are passed to the child.
+    # Returns the stdout (if piped) or the outputs of the pipes, the return code and the rusage.
+    try:
+        proc = subprocess.Popen(cmd, stdout=stdout, stderr=stderr, pass_fds=[w for _, w in pipes])
+    except BaseException:
+        for r, _ in pipes:
+            os.close(r)
+        raise
+    finally:
+        for _, w in pipes:
+            os.close(w)
+    try:
+        if pipes:
+            output = read_pipes(pipes)
+        else:
+            output = proc.stdout.read() if stdout == subprocess.PIPE else None
+        _, status, rusage = os.wait4(proc.pid, 0)
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    finally:
+        if proc.stdout:
+            proc.stdout.close()
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return output, proc.returncode, rusage
+
+
+def shard_of(video_key, num_shards):
+    # Stable across machines and Python versions, unlike `hash`
+    return int(hashlib.md5(video_key.encode()).hexdigest(), 16) % num_shards
+
+
+def shard_suffix(shard_index, num_shards):
+    return "-{:05d}-of-{:05d}".format(shard_index, num_shards)
+
+
+def split_jpeg_stream(data):
+    # Split concatenated jpgs (e.g. the output of `-f image2pipe -c:v mjpeg`) into separate images
+    frames = []
+    pos, size = 0, len(data)
+    while pos < size:
+        if data[pos:pos + 2] != b"\xff\xd8":
+            raise RuntimeError("Broken jpg stream at byte {}".format(pos))
+        end = find_jpeg_end(data, pos)
+        frames.append(data[pos:end])
+        pos = end
+    return frames
+
+
+def find_jpeg_end(data, pos):
+    # Walk through the marker segments, since the header tables may contain any byte sequence
+    i = pos + 2
+    try:
+        while True:
+            if data[i] != 0xFF:
+                raise RuntimeError("Broken jpg stream at byte {}".format(i))
+            marker = data[i + 1]
+            if marker == 0xFF:  # Fill byte
+                i += 1
+            elif marker == 0xD9:  # End of image
+                return i + 2
+            elif 0xD0 <= marker <= 0xD7 or marker == 0x01:  # Markers without payload
+                i += 2
+            else:
+                i += 2 + int.from_bytes(data[i + 2:i + 4], "big")
+                if marker == 0xDA:  # Start of scan, skip the entropy-coded data
+                    while True:
+                        i = data.index(b"\xff", i)
+                        if data[i + 1] == 0x00 or 0xD0 <= data[i + 1] <= 0xD7:
+                            i += 2
+                        elif data[i + 1] == 0xFF:
+                            i += 1
+                        else:
+                            break
+    except (IndexError, ValueError):
+        raise RuntimeError("Truncated jpg stream")
+
+
+def jpeg_size(data):
+    # The (width, height) in the frame header of a jpg, which comes before the entropy-coded data
+    i = 2
+    try:
+        while True:
+            if data[i] != 0xFF:
+                raise RuntimeError("Broken jpg at byte {}".format(i))
+            marker = data[i + 1]
+            if marker == 0xFF:  # Fill byte
+                i += 1
+            elif 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):  # Start of frame
+                return int.from_bytes(data[i + 7:i + 9], "big"), int.from_bytes(data[i + 5:i + 7], "big")
+            elif 0xD0 <= marker <= 0xD7 or marker == 0x01:  # Markers without payload
+                i += 2
+            else:
+                i += 2 + int.from_bytes(data[i + 2:i + 4], "big")
+    except IndexError:
+        raise RuntimeError("Truncated jpg")
+
+
 class RawTextArgumentDefaultsHelpFormatter(argparse.ArgumentDefaultsHelpFormatter,
                                            argparse.RawTextHelpFormatter):
     # RawTextHelpFormatter implements _split_lines
@@ -30,15 +238,46 @@ class RawTextArgumentDefaultsHelpFormatter(argparse.ArgumentDefaultsHelpFormatte
     pass
 
 
+# The options which may differ between the output profiles
+OUTPUT_OPTIONS = [
+    "db_name", "db_type", "layout", "hdf5_compression", "hdf5_chunk", "shard_size", "batch_clips", "batch_bytes",
+    "resize_mode", "resize", "fps", "sample_mode", "sample", "scene_threshold", "audio",
+]
+
+
 def parse_args():
     parser = argparse.ArgumentParser(formatter_class=RawTextArgumentDefaultsHelpFormatter)
 
     # Names and folders
-    parser.add_argument("annotation_file", type=str, help="The annotation file, in json format")
+    parser.add_argument("annotation_file", type=str, help="The annotation file, in json or jsonl format")
     parser.add_argument("--db_name", type=str, help="The database to store extracted frames")
-    parser.add_argument("--db_type", type=str, choices=["LMDB", "HDF5", "FILE", "PKL"], default="HDF5",
-                        help="Type of the database")
+    parser.add_argument("--db_type", type=str, choices=["LMDB", "HDF5", "FILE", "PKL", "NPY", "TAR"],
+                        default="HDF5",
+                        help="Type of the database\n"
+                             "  NPY: Raw uint8 frames without jpg encoding, one .npy per clip, "
+                             "needs `--resize_mode 1`\n"
+                             "  TAR: Size-bounded tar shards, for sequential reading")
+    parser.add_argument("--layout", type=str, default="frame", choices=["frame", "clip"],
+                        help="Layout of the HDF5 / LMDB database\n"
+                             "  frame: One record per frame\n"
+                             "  clip: One record per clip, with all the frames packed")
+    parser.add_argument("--hdf5_compression", type=str, choices=["gzip", "lzf"],
+                        help="Compression of the HDF5 database, only for the `clip` layout")
+    parser.add_argument("--hdf5_chunk", type=int, default=64, help="Frames per chunk of the HDF5 `clip` layout")
+    parser.add_argument("--shard_size", type=int, default=1 << 30,
+                        help="Bytes per shard of the TAR database, a larger video is in a shard of its own")
     parser.add_argument("--tmp_dir", type=str, default="/tmp", help="Temporary folder")
+    parser.add_argument("--resume", action="store_true", help="Skip the videos already done in the database")
+    parser.add_argument("--probe_cache", type=str, help="Cache the probed video info in this sqlite file")
+    parser.add_argument("--failure_cache", type=str,
+                        help="Keep the broken videos in this sqlite file, and skip them in the later runs")
+    parser.add_argument("--retries", type=int, default=3,
+                        help="Num of tries of a video, only for the transient errors (e.g. I/O errors, OOM kills)")
+    parser.add_argument("--retry_backoff", type=float, default=1., help="Seconds before the 2nd try, doubled every try")
+    parser.add_argument("--num_shards", type=int, default=1,
+                        help="Split the videos into n shards by the hash of the keys, for n machines.\n"
+                             "Every shard has a database of its own, see `tools/merge_databases.py`")
+    parser.add_argument("--shard_index", type=int, default=0, help="The shard to extract, from 0 to n - 1")
 
     # Clips
     parser.add_argument("--clips", type=int, default=1, help="Num of clips per video")
@@ -55,24 +294,81 @@ def parse_args():
 
     # Frame sampling options
     parser.add_argument("--fps", type=float, default=-1, help="Sample the video at X fps")
-    parser.add_argument("--sample_mode", type=int, default=0, choices=[0, 1, 2, 3, 4],
+    parser.add_argument("--sample_mode", type=int, default=0, choices=[0, 1, 2, 3, 4, 5, 6],
                         help="Frame sampling options\n"
                              "  0: Keep all frames\n"
                              "  1: Uniformly sample n frames\n"
                              "  2: Randomly sample n continuous frames\n"
                              "  3: Randomly sample n frames\n"
-                             "  4: Sample 1 frame every n frames"
+                             "  4: Sample 1 frame every n frames\n"
+                             "  5: Keyframes only, the other frames are not decoded at all. At most n frames if set\n"
+                             "  6: The first frame, and the frames of scene changes. At most n frames if set"
                         )
     parser.add_argument("--sample", type=int, help="How many frames")
+    parser.add_argument("--scene_threshold", type=float, default=0.3,
+                        help="Scene change score (0 to 1) of a new scene, for `--sample_mode 6`")
+
+    # Audio
+    parser.add_argument("--audio", type=str, choices=["pcm", "logmel"],
+                        help="Also extract the audio of every clip, decoded along with the frames, in the .npy format\n"
+                             "  pcm: Mono 16-bit samples\n"
+                             "  logmel: Log-mel spectrogram of 25ms windows every 10ms, in float32 (frames, mel_bins)")
+    parser.add_argument("--audio_rate", type=int, default=16000, help="Sample rate of the audio")
+    parser.add_argument("--mel_bins", type=int, default=64, help="Num of mel bins of the log-mel spectrogram")
 
     # performance
     parser.add_argument("--threads", type=int, default=0, help="Number of threads")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="Number of worker processes, the frames are written by a dedicated process.\n"
+                             "Overrides `threads` if set")
+    parser.add_argument("--queue_size", type=int, default=0,
+                        help="Max num of clips waiting for the writer process, default is twice the processes")
+    parser.add_argument("--inflight", type=int, default=0,
+                        help="Max num of videos submitted to the threads / processes at once, "
+                             "default is 4 times of them")
+    parser.add_argument("--schedule", type=str, default="order", choices=["order", "longest"],
+                        help="Order of the videos\n"
+                             "  order: As in the annotation file\n"
+                             "  longest: Probe the durations of all videos at first, and start from the longest,\n"
+                             "           best with `--probe_cache` so that the videos are only probed once")
+    parser.add_argument("--segments", type=int, default=1,
+                        help="Split a long video (or clip) into n segments, "
+                             "decoded by n ffmpeg processes at the same time.\n"
+                             "Not used if the frames are sampled by ffmpeg (see `--sample_mode`), or by scene changes")
+    parser.add_argument("--segment_min", type=float, default=60,
+                        help="Only split the videos (or clips) longer than s seconds")
+    parser.add_argument("--batch_clips", type=int, default=1, help="Commit the clips to the database every n clips")
+    parser.add_argument("--batch_bytes", type=int, default=0,
+                        help="Also commit the clips once they reach n bytes, 0 to disable")
+    parser.add_argument("--use_tmp_dir", action="store_true",
+                        help="Extract frames to jpg files in the temporary folder, rather than a pipe (for debugging)")
     parser.add_argument("--keep", action="store_true", help="Do not delete temporary files at last")
+    parser.add_argument("--outputs", type=str,
+                        help="A json file of a list of output profiles, to decode every video once for all of them.\n"
+                             "Every profile has a database of its own, and replaces some of these options:\n"
+                             "  {}".format(", ".join(OUTPUT_OPTIONS)))
+    parser.add_argument("--profile", type=str,
+                        help="Save the time and resource usage of every stage of every video to this jsonl file,\n"
+                             "and a summary of them to `*-summary.json`")
 
     args = parser.parse_args()
-    args = EasyDict(args.__dict__)
+    options = dict(args.__dict__, outputs=None)
+    outputs = json.load(open(args.outputs)) if args.outputs else None
+    args = EasyDict(options)
     args = modify_args(args)
 
+    # Every output profile is the command line with some options replaced
+    if outputs:
+        for x in outputs:
+            unknown = set(x) - set(OUTPUT_OPTIONS)
+            assert not unknown, "Not an option of the outputs: {}".format(", ".join(sorted(unknown)))
+        args.outputs = [modify_args(EasyDict({**options, **x})) for x in outputs]
+        assert len({x.db_name for x in args.outputs}) == len(args.outputs), "Every output needs a database of its own"
+        # The outputs share the decoder
+        assert all(x.decode_setting == args.outputs[0].decode_setting for x in args.outputs), \
+            "Keyframes only (`sample_mode` 5) must be set for all outputs or none"
+        args.decode_setting = args.outputs[0].decode_setting
+
     return args
 
 
@@ -94,41 +390,103 @@ def modify_args(args):
         elif args.db_type == 'LMDB':
             args.db_name += ".lmdb"
 
+    # Every shard writes a database and a fix file of its own, e.g. `dataset-00003-of-00020.hdf5`
+    args.num_shards = max(args.num_shards, 1)
+    assert 0 <= args.shard_index < args.num_shards, "Shard index must be in [0, {})".format(args.num_shards)
+    args.shard_suffix = ""
+    if args.num_shards > 1:
+        args.shard_suffix = shard_suffix(args.shard_index, args.num_shards)
+        db_path = Path(args.db_name)
+        if db_path.suffix.lower() in (".hdf5", ".lmdb"):
+            args.db_name = str(db_path.with_name(db_path.stem + args.shard_suffix + db_path.suffix))
+        else:
+            args.db_name += args.shard_suffix
+
+    # Keeping the temporary files only makes sense when there are temporary files
+    if args.keep:
+        args.use_tmp_dir = True
+
     # Range check
+    args.retries = max(args.retries, 1)
     args.clips = max(args.clips, 1)
     args.duration = max(args.duration, 0)
 
     # Parse the resize mode
-    args.vf_setting = []
+    args.filters = []
+    args.frame_size = None
     if args.resize_mode == 0:
         pass
     elif args.resize_mode == 1:
         W, H, *_ = args.resize.split("x")
         W, H = int(W), int(H)
         assert W > 0 and H > 0
-        args.vf_setting.extend([
-            "-vf", "scale={}:{}".format(W, H)
-        ])
+        args.filters.append("scale={}:{}".format(W, H))
+        args.frame_size = (W, H)
     elif args.resize_mode == 2:
         side = args.resize[0].lower()
         assert side in ['l', 's'], "The (L)onger side, or the (S)horter side?"
         scale = int(args.resize[1:])
         assert scale > 0
-        args.vf_setting.extend([
-            "-vf",
+        args.filters.append(
             "scale='iw*1.0/{0}(iw,ih)*{1}':'ih*1.0/{0}(iw,ih)*{1}'".format("max" if side == 'l' else 'min', scale)
-        ])
+        )
     else:
         raise Exception('Unspecified frame scale option')
 
+    # Keyframes are picked by the decoder, which skips the other frames,
+    # and scene changes by the filter graph, before the frames are scaled and encoded
+    args.decode_setting = []
+    if args.sample_mode == 5:
+        args.decode_setting.extend(["-skip_frame", "nokey"])
+    elif args.sample_mode == 6:
+        args.filters.insert(0, "select='eq(n,0)+gt(scene,{})'".format(args.scene_threshold))
+
     # Parse the fps setting
+    args.rate_setting = []
     if args.fps > 0:
-        args.vf_setting.extend([
+        args.rate_setting.extend([
             "-r", "{}".format(args.fps)
         ])
 
+    # Raw frames are stacked into arrays, so they must be of the same size
+    args.frame_format = "jpg"
+    if args.db_type == "NPY":
+        assert args.frame_size, "NPY database needs frames of fixed size, i.e. `--resize_mode 1`"
+        assert not args.use_tmp_dir, "NPY database does not support temporary files"
+        args.frame_format = "rgb24"
+
+    args.storage_setting = {
+        "batch_clips": max(args.batch_clips, 1),
+        "batch_bytes": max(args.batch_bytes, 0),
+        "resume": args.resume,
+    }
+    if args.db_type == "NPY":
+        args.storage_setting["frame_size"] = args.frame_size
+    elif args.db_type == "LMDB":
+        args.storage_setting["layout"] = args.layout
+    elif args.db_type == "TAR":
+        args.storage_setting["shard_size"] = args.shard_size
+    elif args.db_type == "HDF5":
+        args.storage_setting.update({
+            "layout": args.layout,
+            "compression": args.hdf5_compression,
+            "chunk_frames": args.hdf5_chunk,
+        })
+
     if args.threads:
         if args.threads < 0:
             args.threads = max(os.cpu_count() / 2, 1)
 
+    if args.processes:
+        if args.processes < 0:
+            args.processes = os.cpu_count()
+        if args.queue_size <= 0:
+            args.queue_size = args.processes * 2
+
+    # The wall time of every video is needed by the profile, and by the makespan of the schedule
+    args.trace = bool(args.profile) or args.schedule != "order"
+
+    if args.inflight <= 0:
+        args.inflight = int(args.processes or args.threads or 1) * 4
+
     return args
@@ -1,215 +1,649 @@
-import json
-import re
+import math
+import multiprocessing
+import os
 import shutil
+import signal
 import subprocess
+import tempfile
+import threading
+import time
 import warnings
+from collections import Counter
 from concurrent import futures
+from itertools import islice
 from pathlib import Path
 from random import randint, random, shuffle
 
 from tqdm import tqdm
 
-from storage import STORAGE_TYPES
-from util import parse_args, retry
+from audio import audio_meta, encode_audio
+from manifest import FailLog, Manifest
+from probe import FailureCache, ProbeCache, get_video_duration, get_video_meta, parse_frame_rate
+from profiler import NULL_TRACE, Profiler, VideoTrace, add_rusage
+from schedule import LongestFirst
+from storage import STORAGE_TYPES, QueueStorage, collect_writers, discard, storage_writer, writers_gone
+from util import (VideoError, check_ffmpeg, failure_reason, is_broken, jpeg_size, parse_args, retry, run_command,
+                  shard_of, split_jpeg_stream)
+
+
+def get_clip_windows(args, video_file, video_meta):
+    # Pick the (start, duration) of every clip up front, `None` stands for the whole video
+    if args.duration <= 0:
+        return [None] * args.clips
+
+    video_duration, _ = get_video_duration(video_file, video_meta)
+    if video_duration <= 0:
+        warnings.warn("Ignore `duration` parameter for video {}.".format(video_file))
+        return [None] * args.clips
+
+    windows = []
+    for _ in range(args.clips):
+        sta = max(0., random() * (video_duration - args.duration))
+        dur = min(args.duration, video_duration - sta)
+        windows.append((sta, dur))
+    return windows
+
+
+def get_filter_chain(args, select_expr=None):
+    # Select the frames before scaling, so that the dropped frames are neither scaled nor encoded
+    filters = list(args.filters)
+    if select_expr:
+        filters.insert(0, "select='{}'".format(select_expr))
+    return filters
+
+
+def get_vf_setting(args, select_expr=None):
+    vf_setting = []
+    filters = get_filter_chain(args, select_expr)
+    if filters:
+        vf_setting.extend(["-vf", ",".join(filters)])
+    vf_setting.extend(args.rate_setting)
+    return vf_setting
+
+
+def get_format_setting(args, target, tmp_dir=None):
+    if args.frame_format == "rgb24":
+        # Raw pixels of fixed size
+        return ["-f", "rawvideo", "-pix_fmt", "rgb24", target]
+    elif tmp_dir is None:
+        # Stream the jpgs through a pipe
+        return ["-qscale:v", "2", "-f", "image2pipe", "-c:v", "mjpeg", target]
+    else:
+        return ["-qscale:v", "2", str(tmp_dir / "%8d.jpg")]
+
+
+def split_frames(args, output, tmp_dir=None):
+    if args.frame_format == "rgb24":
+        # Split the frames by size
+        W, H = args.frame_size
+        frame_bytes = W * H * 3
+        frames = [(i + 1, output[x:x + frame_bytes])
+                  for i, x in enumerate(range(0, len(output) - frame_bytes + 1, frame_bytes))]
+    elif tmp_dir is None:
+        # Split the jpgs in memory
+        frames = list(enumerate(split_jpeg_stream(output), 1))
+    else:
+        frames = [(int(f.name.split('.')[0]), f.read_bytes()) for f in tmp_dir.iterdir()]
+        frames.sort(key=lambda x: x[0])
+    return frames
 
-ffmpeg_duration_template = re.compile(r"time=\s*(\d+):(\d+):(\d+)\.(\d+)")
 
+def video_to_outputs(args, video_file, window, outputs, tmp_dir=None, error_when_empty=True, record=None,
+                     audio_rate=None):
+    # Decode once for all the outputs, each a (profile, select expression) with its own filters and format,
+    # and the audio too (mono 16-bit pcm) if `audio_rate` is set.
+    # Returns the frames of every output, and the audio or `None`.
+    # Seek and cut on the input side, so that ffmpeg does not decode everything before the clip,
+    # and the windows next to each other have every frame once. A window of `None` duration goes on to the end.
+    seek_setting = []
+    if window:
+        sta, dur = window
+        seek_setting.extend(["-ss", "{}".format(sta)])
+        if dur is not None:
+            seek_setting.extend(["-t", "{}".format(dur)])
 
-def get_video_duration(video_file):
     cmd = [
         "ffmpeg",
+        "-loglevel", "error",
+        "-vsync", "vfr",
+        *args.decode_setting,
+        *seek_setting,
         "-i", str(video_file),
-        "-f", "null", "-"
     ]
 
-    output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-    result_all = ffmpeg_duration_template.findall(output.decode())
-    if result_all:
-        result = result_all[-1]
-        duration = float(result[0]) * 60 * 60 \
-                   + float(result[1]) * 60 \
-                   + float(result[2]) \
-                   + float(result[3]) * (10 ** -len(result[3]))
+    pipes, output_tmp_dirs = [], [tmp_dir] * len(outputs)
+    if len(outputs) == 1 and not audio_rate:
+        profile, select_expr = outputs[0]
+        cmd.extend(get_vf_setting(profile, select_expr))
+        cmd.extend(get_format_setting(profile, "-", tmp_dir))
     else:
-        duration = -1
-    return duration
+        # Split the decoded frames to a filter chain per output, and every output to a pipe of its own
+        graph = ["[0:v]split={}{}".format(len(outputs), "".join("[in{}]".format(i) for i in range(len(outputs))))]
+        for i, (profile, select_expr) in enumerate(outputs):
+            graph.append("[in{0}]{1}[out{0}]".format(i, ",".join(get_filter_chain(profile, select_expr)) or "null"))
+        cmd.extend(["-filter_complex", ";".join(graph)])
+
+        if tmp_dir:
+            output_tmp_dirs = [tmp_dir / "{:02d}".format(i) for i in range(len(outputs))]
+            for x in output_tmp_dirs:
+                x.mkdir(exist_ok=True, parents=True)
+        else:
+            pipes = [os.pipe() for _ in outputs]
+        for i, (profile, _) in enumerate(outputs):
+            cmd.extend(["-map", "[out{}]".format(i), *profile.rate_setting])
+            cmd.extend(get_format_setting(profile, "pipe:{}".format(pipes[i][1]) if pipes else "-", output_tmp_dirs[i]))
+
+        # The audio of the same window, from the same demuxer
+        if audio_rate:
+            pipes.append(os.pipe())
+            cmd.extend(["-map", "0:a:0", "-ac", "1", "-ar", "{}".format(audio_rate), "-f", "s16le",
+                        "pipe:{}".format(pipes[-1][1])])
+
+    # The errors go to a file rather than a pipe, which could fill up and block ffmpeg while stdout is read
+    with tempfile.TemporaryFile() as stderr:
+        output, returncode, rusage = run_command(
+            cmd, stdout=None if tmp_dir or pipes else subprocess.PIPE, stderr=stderr, pipes=pipes
+        )
+        stderr.seek(0)
+        check_ffmpeg(returncode, stderr.read())
+
+    audio = output.pop() if audio_rate else None
+    outputs_frames = [
+        split_frames(profile, data, output_tmp_dir)
+        for (profile, _), data, output_tmp_dir in zip(
+            outputs, output if pipes and not tmp_dir else [output] * len(outputs), output_tmp_dirs
+        )
+    ]
 
+    if record is not None:
+        add_rusage(record, rusage)
+        for frames in outputs_frames:
+            record["frames"] += len(frames)
+            record["output_bytes"] += sum(len(data) for _, data in frames)
+        record["output_bytes"] += len(audio or b"")
 
-def get_video_meta(video_file):
-    try:
-        cmd = [
-            "ffprobe",
-            "-v", "quiet",
-            "-show_streams",
-            "-print_format", "json",
-            str(video_file)
-        ]
-        output = subprocess.check_output(cmd)
-        output = json.loads(output)
+    if error_when_empty and not all(outputs_frames):
+        raise empty_error(window is None and not any(select_expr for _, select_expr in outputs))
+
+    return outputs_frames, audio
+
+
+def empty_error(whole_video):
+    # No frame in the whole video tells the video is broken,
+    # while no frame in a window, or in the selected frames, depends on the options of the run
+    return VideoError("Extract frame failed", "empty" if whole_video else "empty_sample")
 
-        streamsbytype = {}
-        for stream in output["streams"]:
-            streamsbytype[stream["codec_type"].lower()] = stream
 
-        return streamsbytype
+def get_segments(args, outputs, video_file, video_meta, window):
+    # Split a long window into (start, duration) segments to decode at the same time, or `None` if not split.
+    # Not for the scene changes, as every segment would start with a new scene.
+    if args.segments <= 1 or any(x.sample_mode == 6 for x in outputs):
+        return None
+    if window is None:
+        sta, dur = 0., get_video_duration(video_file, video_meta)[0]
+    else:
+        sta, dur = window
+    if dur < max(args.segment_min, 0.) or dur <= 0:
+        return None
+
+    # Cut in the middle of two frames, so that no frame is on a boundary, where ffmpeg may keep it on both sides
+    bounds = [sta + dur * i / args.segments for i in range(args.segments + 1)]
+    try:
+        rate = parse_frame_rate(video_meta["video"]["r_frame_rate"])
     except:
-        return {}
-
-
-@retry()
-def video_to_frames(args, video_file, video_meta, tmp_dir, error_when_empty=True):
-    # Random clip the video
-    clip_setting = []
-    if args.duration > 0:
-        try:
-            video_duration = float(video_meta["video"]["duration"])
-        except:
-            video_duration = get_video_duration(video_file)
-        if video_duration > 0:
-            sta = max(0., random() * (video_duration - args.duration))
-            dur = min(args.duration, video_duration - sta)
-            clip_setting.extend([
-                "-ss", "{}".format(sta),
-                "-t", "{}".format(dur)
-            ])
+        rate = 0
+    if rate > 0:
+        bounds = [max((math.ceil(x * rate - 1e-6) - 0.5) / rate, 0.) for x in bounds]
+
+    segments = [(a, b - a) for a, b in zip(bounds, bounds[1:])]
+    if window is None:
+        # The duration may be short of the last frames, so the last segment goes on to the end
+        segments[-1] = (bounds[-2], None)
+    return segments
+
+
+def decode_segments(extract, args, video_file, segments, outputs, tmp_dir=None, record=None, audio_rate=None):
+    # Decode the segments by concurrent ffmpeg processes, and join the frames of every output (and the audio) in order
+    def decode(ith_segment, segment):
+        segment_tmp_dir, segment_record = None, Counter()
+        if tmp_dir:
+            segment_tmp_dir = tmp_dir / "{:03d}".format(ith_segment)
+            segment_tmp_dir.mkdir(exist_ok=True, parents=True)
+        outputs_frames, audio = extract(args, video_file, segment, [(x, None) for x in outputs], segment_tmp_dir,
+                                        error_when_empty=False, record=segment_record, audio_rate=audio_rate)
+        return outputs_frames, audio, segment_record
+
+    with futures.ThreadPoolExecutor(max_workers=len(segments)) as executor:
+        decoded = list(executor.map(decode, range(len(segments)), segments))
+
+    outputs_frames = [
+        list(enumerate([data for segment_frames, _, _ in decoded for _, data in segment_frames[i]], 1))
+        for i in range(len(outputs))
+    ]
+    audio = b"".join(x for _, x, _ in decoded) if audio_rate else None
+    if record is not None:
+        for _, _, segment_record in decoded:
+            for key, value in segment_record.items():
+                record[key] = max(record[key], value) if key == "child_maxrss" else record[key] + value
+    if not all(outputs_frames):
+        # Only the segments of the whole video go on to the end
+        raise empty_error(segments[-1][1] is None)
+    return outputs_frames, audio
+
+
+def get_frame_size(args, frame):
+    # Saved along with the video, so that the readers know the size before decoding
+    if args.frame_format == "rgb24":
+        return list(args.frame_size)
+    return list(jpeg_size(frame))
+
+
+def get_sample_index(args, tot):
+    # The index of frames to keep, `None` means keeping all frames
+    if not args.sample_mode:
+        return None
+
+    # Keyframes or scene changes, all of them unless more than n
+    if args.sample_mode in (5, 6) and (not args.sample or tot <= args.sample):
+        return None
+
+    assert args.sample > 0, "Sample must >0, but get {}".format(args.sample)
+
+    if args.sample_mode in (1, 5, 6):  # Uniformly sample n frames
+        if args.sample == 1:
+            index = [tot >> 1]
         else:
-            warnings.warn("Ignore `duration` parameter for video {}.".format(video_file))
+            step = (tot - 1.) / (args.sample - 1)
+            index = [round(x * step) for x in range(args.sample)]
+    elif args.sample_mode == 2:  # Randomly sample n continuous frames
+        sta = randint(0, max(0, tot - args.sample - 1))
+        index = list(range(sta, min(sta + args.sample, tot)))
+    elif args.sample_mode == 3:  # Randomly sample n frames
+        index = list(range(tot))
+        shuffle(index)
+        index = sorted(index[:min(args.sample, tot)])
+    elif args.sample_mode == 4:  # Sample 1 frame every n frames
+        index = list(range(0, tot, args.sample))
+    else:
+        raise AttributeError("Sample mode is not supported")
 
-    cmd = [
-        "ffmpeg",
-        "-loglevel", "panic",
-        "-vsync", "vfr",
-        "-i", str(video_file),
-        *args.vf_setting,
-        *clip_setting,
-        "-qscale:v", "2",
-        str(tmp_dir / "%8d.jpg")
-    ]
-    subprocess.call(cmd)
+    return index
 
-    frames = [(int(f.name.split('.')[0]), f) for f in tmp_dir.iterdir()]
-    frames.sort(key=lambda x: x[0])
 
-    if error_when_empty and not frames:
-        raise RuntimeError("Extract frame failed")
+def get_select_setting(args, video_meta, window, num_clips):
+    # Sample the frames before decoding, so that ffmpeg can drop the others in the filter graph.
+    # Returns the `select` expression, the number of frames it keeps (`None` if unknown),
+    # and the index of every clip into the kept frames (`None` means all of them).
+    # Returns `None` if the frames can only be sampled after decoding.
+    if not args.sample_mode or args.fps > 0:
+        return None
 
-    return frames
+    # Keyframes and scene changes are picked by the decoder and the filter graph, the count is unknown until then
+    if args.sample_mode in (5, 6):
+        return None
 
+    if args.sample_mode == 4:
+        return "not(mod(n,{}))".format(args.sample), None, [None] * num_clips
 
-@retry()
-def sample_frames(args, frames, error_when_empty=True):
-    if args.sample_mode:
-        assert args.sample > 0, "Sample must >0, but get {}".format(args.sample)
+    # Other modes need the exact frame count, which is only known for the whole video
+    if window:
+        return None
+    try:
+        tot = int(video_meta["video"]["nb_frames"])
+    except:
+        return None
+    if tot <= 0:
+        return None
 
-        tot = len(frames)
-        if args.sample_mode == 1:  # Uniformly sample n frames
-            if args.sample == 1:
-                index = [tot >> 1]
-            else:
-                step = (tot - 1.) / (args.sample - 1)
-                index = [round(x * step) for x in range(args.sample)]
-            frames = [frames[x] for x in index]
-        elif args.sample_mode == 2:  # Randomly sample n continuous frames
-            sta = randint(0, max(0, len(frames) - args.sample - 1))
-            frames = frames[sta:sta + args.sample]
-        elif args.sample_mode == 3:  # Randomly sample n frames
-            shuffle(frames)
-            frames = frames[:min(args.sample, tot)]
-            frames.sort(key=lambda x: x[0])
-        elif args.sample_mode == 4:  # Sample 1 frame every n frames
-            frames = frames[::args.sample]
-        else:
-            raise AttributeError("Sample mode is not supported")
+    clip_index = [get_sample_index(args, tot) for _ in range(num_clips)]
+    selected = sorted(set(x for index in clip_index for x in index))
+    position = {x: i for i, x in enumerate(selected)}
+
+    select_expr = "+".join("eq(n,{})".format(x) for x in selected)
+    return select_expr, len(selected), [[position[x] for x in index] for index in clip_index]
+
+
+def sample_frames(args, frames, error_when_empty=True):
+    index = get_sample_index(args, len(frames))
+    if index is not None:
+        frames = [frames[x] for x in index]
 
     if error_when_empty and not frames:
-        raise RuntimeError("No frame selected")
+        raise VideoError("No frame selected", "empty_sample")
 
     return frames
 
 
-def process(args, video_key, video_info, frame_db):
+def process(args, video_key, video_info, frame_dbs, trace=NULL_TRACE):
     video_file = Path(video_info['path'])
     video_tmp_dir = Path(args.tmp_dir) / "{}".format(video_key)
-    video_tmp_dir.mkdir(exist_ok=True)
+    if args.use_tmp_dir:
+        video_tmp_dir.mkdir(exist_ok=True)
 
     if not video_file.exists():
-        raise RuntimeError("Video not exists")
+        raise VideoError("Video not exists", "missing")
 
-    video_meta = get_video_meta(video_file)
+    failure_cache = FailureCache.open(args.failure_cache) if args.failure_cache else None
+    failure = failure_cache.get(video_file) if failure_cache is not None else None
+    if failure:
+        raise VideoError("Known broken video, {}".format(failure["error"]), failure["reason"])
+
+    with trace.stage("probe"):
+        probe_cache = ProbeCache.open(args.probe_cache) if args.probe_cache else None
+        video_meta = get_video_meta(video_file, probe_cache, duration=args.duration > 0)
     if not video_meta:
-        raise RuntimeError("Can not get video info")
+        raise VideoError("Can not get video info", "probe")
+
+    # Every output has its own filters, sampling and database, and they share the decoding
+    outputs = args.outputs or [args]
+
+    # Only the transient errors of ffmpeg are tried again
+    extract = retry(args.retries, args.retry_backoff)(video_to_outputs)
+
+    # The audio is decoded along with the frames, for the outputs which keep it, if the video has any
+    audio_rate = args.audio_rate if any(x.audio for x in outputs) and "audio" in video_meta else None
+
+    # Decode once per distinct clip window, and share the frames between the clips covering it
+    frame_sizes = [None] * len(outputs)
+    with trace.stage("windows"):
+        windows = get_clip_windows(args, video_file, video_meta)
+    for ith_decode, window in enumerate(sorted(set(windows), key=windows.index)):
+        clips = [ith_clip for ith_clip, clip_window in enumerate(windows) if clip_window == window]
+
+        clip_tmp_dir = None
+        if args.use_tmp_dir:
+            clip_tmp_dir = video_tmp_dir / "{:03d}".format(ith_decode)
+            clip_tmp_dir.mkdir(exist_ok=True, parents=True)
+
+        # Get the sampled frames directly, if the frames can be sampled before decoding.
+        # Otherwise get all frames, in segments if the window is long.
+        select_settings = [get_select_setting(x, video_meta, window, len(clips)) for x in outputs]
+        segments = None if any(select_settings) else get_segments(args, outputs, video_file, video_meta, window)
+        with trace.stage("decode") as record:
+            if segments:
+                outputs_frames, audio = decode_segments(extract, args, video_file, segments, outputs, clip_tmp_dir,
+                                                        record=record, audio_rate=audio_rate)
+            else:
+                outputs_frames, audio = extract(args, video_file, window,
+                                                [(x, y[0] if y else None) for x, y in zip(outputs, select_settings)],
+                                                clip_tmp_dir, record=record, audio_rate=audio_rate)
+
+        # The same audio for all the clips of the window, encoded once per format
+        encoded_audio = {}
+        if audio is not None:
+            with trace.stage("audio") as record:
+                for output in outputs:
+                    if output.audio and output.audio not in encoded_audio:
+                        encoded_audio[output.audio] = encode_audio(output, audio)
+                record["bytes"] += sum(len(x) for x in encoded_audio.values())
+
+        for ith_output, (output, frame_db, select_setting, frames) in enumerate(
+                zip(outputs, frame_dbs, select_settings, outputs_frames)):
+            if select_setting and select_setting[1] is not None and len(frames) != select_setting[1]:
+                warnings.warn("Frame count mismatch for video {}, sample after decoding.".format(video_file))
+                select_setting = None
+                output_tmp_dir = None
+                if clip_tmp_dir:
+                    output_tmp_dir = clip_tmp_dir / "all-{:02d}".format(ith_output)
+                    output_tmp_dir.mkdir(exist_ok=True, parents=True)
+                with trace.stage("decode") as record:
+                    frames = extract(args, video_file, window, [(output, None)], output_tmp_dir, record=record)[0][0]
+
+            for ith_clip, index in zip(clips, select_setting[2] if select_setting else [None] * len(clips)):
+                # Sample frames
+                with trace.stage("sample"):
+                    if not select_setting:
+                        clip_frames = sample_frames(output, list(frames))
+                    elif index is None:
+                        clip_frames = frames
+                    else:
+                        clip_frames = [frames[x] for x in index]
+
+                # Save to database
+                with trace.stage("store") as record:
+                    frame_db.put(video_key, ith_clip, [data for _, data in clip_frames],
+                                 encoded_audio.get(output.audio))
+                    record["frames"] += len(clip_frames)
+                    record["bytes"] += sum(len(data) for _, data in clip_frames)
+                if frame_sizes[ith_output] is None and clip_frames:
+                    frame_sizes[ith_output] = get_frame_size(output, clip_frames[0][1])
+
+    with trace.stage("store"):
+        for output, frame_db, frame_size in zip(outputs, frame_dbs, frame_sizes):
+            meta = {"frame_size": frame_size} if frame_size else {}
+            if output.audio and audio_rate:
+                meta["audio"] = audio_meta(output)
+            frame_db.finish(video_key, meta or None)
+
+    if args.use_tmp_dir and not args.keep:
+        with trace.stage("cleanup"):
+            shutil.rmtree(video_tmp_dir, ignore_errors=True)
+
+    # Tell how the duration is found, for auditing
+    if "duration" in video_meta:
+        return "OK, duration by {}".format(video_meta["duration"][1])
+    return "OK"
 
-    for ith_clip in range(args.clips):
-        clip_tmp_dir = video_tmp_dir / "{:03d}".format(ith_clip)
-        clip_tmp_dir.mkdir(exist_ok=True, parents=True)
 
-        # Get all frames
-        frames = video_to_frames(args, video_file, video_meta, clip_tmp_dir)
+def run_video(args, video_key, video_info, frame_dbs):
+    # Returns the status, and the trace of the stages if profiling.
+    # A failed video carries its trace in the exception.
+    trace = VideoTrace(video_key) if args.trace else NULL_TRACE
+    try:
+        video_status = process(args, video_key, video_info, frame_dbs, trace)
+    except Exception as e:
+        e.trace = trace.to_dict(str(e))
+        for frame_db in frame_dbs:
+            frame_db.drop(video_key)
+        raise
+    return video_status, trace.to_dict(video_status)
+
+
+def add_failure(fails, failure_cache, video_key, video_path, e):
+    fails.add(video_key, video_path, e)
+    # Remember the broken videos, but not the ones which may work next time,
+    # nor the errors which may not be of the video, e.g. of the options or the code
+    if failure_cache is None or not is_broken(e) or not video_path:
+        return
+    try:
+        if failure_cache.get(video_path) is None:
+            failure_cache.put(video_path, {"reason": failure_reason(e), "error": str(e)})
+    except OSError:
+        pass
 
-        # Sample frames
-        frames = sample_frames(args, frames)
 
-        # Save to database
-        frame_db.put(video_key, ith_clip, clip_tmp_dir, frames)
+def iter_videos(manifest, args, done=()):
+    # The videos of this shard, except the ones done
+    for video_key, video_info in manifest:
+        if args.num_shards > 1 and shard_of(video_key, args.num_shards) != args.shard_index:
+            continue
+        if video_key not in done:
+            yield video_key, video_info
 
-        if not args.keep:
-            shutil.rmtree(clip_tmp_dir, ignore_errors=True)
 
-    if not args.keep:
-        shutil.rmtree(video_tmp_dir, ignore_errors=True)
+worker_dbs = None
 
-    return "OK"
+
+def init_worker(queues):
+    # The worker processes hand the frames over to the storage writer processes, one per output
+    global worker_dbs
+    worker_dbs = [QueueStorage(x) for x in queues]
+
+    # Ctrl-C is handled by the main process, which lets the running videos finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def process_in_worker(args, video_key, video_info):
+    return run_video(args, video_key, video_info, worker_dbs)
 
 
 if "__main__" == __name__:
     args = parse_args()
-    Path(args.tmp_dir).mkdir(exist_ok=True)
-
-    frame_db = STORAGE_TYPES[args.db_type](args.db_name)
-
-    annotation_all = json.load(Path(args.annotation_file).open())
-    annotation = annotation_all["annotation"]
-    total = len(annotation)
-    fails = []
-
-    if args.threads > 0:
-        with futures.ThreadPoolExecutor(max_workers=args.threads) as executor:
-            jobs = {
-                executor.submit(process, args, video_key, video_info, frame_db): video_info['path']
-                for video_key, video_info in annotation.items()
-            }
-            for future in tqdm(futures.as_completed(jobs), total=total):
+    if args.use_tmp_dir:
+        Path(args.tmp_dir).mkdir(exist_ok=True)
+
+    manifest = Manifest(args.annotation_file)
+    fails = FailLog(manifest.output_path("-fails.jsonl", args.shard_suffix))
+    failure_cache = FailureCache(args.failure_cache) if args.failure_cache else None
+    status_count = Counter()
+    profiler = Profiler(args.profile) if args.profile else None
+    outputs = args.outputs or [args]
+
+    done = set()
+    if args.resume:
+        # Skip the videos already in all the databases
+        for ith_output, output in enumerate(outputs):
+            frame_db = STORAGE_TYPES[output.db_type](output.db_name, **output.storage_setting)
+            done = frame_db.done_videos() if ith_output == 0 else done & frame_db.done_videos()
+            frame_db.close()
+
+    # Count the videos in a pass of their own, as the manifest may be too large to keep
+    num_videos, total = 0, 0
+    for video_key, _ in iter_videos(manifest, args):
+        num_videos += 1
+        total += video_key not in done
+    if args.num_shards > 1:
+        print("Shard {} of {}, {} videos".format(args.shard_index, args.num_shards, num_videos))
+    if args.resume:
+        print("Resume from {} videos already done".format(num_videos - total))
+    todo = iter_videos(manifest, args, done)
+    schedule = None
+    if args.schedule == "longest":
+        schedule = LongestFirst(args, todo, int(args.processes or args.threads or 1))
+        todo = iter(schedule)
+
+    writers = None
+    if args.processes > 0:
+        # Open every database once, so that a database which can not be opened (e.g. in another layout)
+        # stops the run here, rather than in the writer
+        for output in outputs:
+            STORAGE_TYPES[output.db_type](output.db_name, **output.storage_setting).close()
+
+        # Decode in a process pool, and write in a single process per output which owns the database
+        queues = [multiprocessing.Queue(maxsize=args.queue_size) for _ in outputs]
+        writer_fails = multiprocessing.Queue()
+        writers = [
+            multiprocessing.Process(target=storage_writer, name=x.db_name,
+                                    args=(x.db_type, x.db_name, queue, writer_fails, x.storage_setting))
+            for x, queue in zip(outputs, queues)
+        ]
+        for x in writers:
+            x.start()
+        executor = futures.ProcessPoolExecutor(max_workers=args.processes,
+                                               initializer=init_worker, initargs=(queues,))
+        task, task_args = process_in_worker, ()
+    else:
+        frame_dbs = [STORAGE_TYPES[x.db_type](x.db_name, **x.storage_setting) for x in outputs]
+        executor = futures.ThreadPoolExecutor(max_workers=args.threads) if args.threads > 0 else None
+        task, task_args = run_video, (frame_dbs,)
+
+    start = time.perf_counter()
+    try:
+        if executor:
+            with executor:
+                # At most `inflight` videos are submitted at once, the next ones only as the running ones finish
+                jobs = {}
+                progress = tqdm(total=total)
                 try:
-                    video_status = future.result()
+                    for video_key, video_info in islice(todo, args.inflight):
+                        job = executor.submit(task, args, video_key, video_info, *task_args)
+                        jobs[job] = (video_key, video_info['path'])
+                    while jobs:
+                        finished, _ = futures.wait(jobs, timeout=1, return_when=futures.FIRST_COMPLETED)
+                        for future in finished:
+                            video_key, video_path = jobs.pop(future)
+                            try:
+                                video_status, video_trace = future.result()
+                            except Exception as e:
+                                tqdm.write("{} : {}".format(video_path, e))
+                                add_failure(fails, failure_cache, video_key, video_path, e)
+                                video_trace = getattr(e, "trace", None)
+                            else:
+                                tqdm.write("{} : {}".format(video_path, video_status))
+                                status_count[video_status] += 1
+                            if profiler:
+                                profiler.add(video_trace)
+                            if schedule:
+                                schedule.add(video_trace)
+                            progress.update()
+                        for video_key, video_info in islice(todo, len(finished)):
+                            job = executor.submit(task, args, video_key, video_info, *task_args)
+                            jobs[job] = (video_key, video_info['path'])
+
+                        # Nothing is written without the writer, so stop rather than wait for it forever
+                        gone = writers_gone(writers or [])
+                        if gone:
+                            tqdm.write("The storage writer of {} is gone, stopping".format(gone[0].name))
+                            for writer, queue in zip(writers, queues):
+                                if writer in gone:
+                                    threading.Thread(target=discard, args=(queue,), daemon=True).start()
+                            executor.shutdown(wait=True, cancel_futures=True)
+                            break
+                except KeyboardInterrupt:
+                    tqdm.write("Interrupted, waiting for the running videos")
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    raise
+                finally:
+                    progress.close()
+        else:
+            for video_key, video_info in tqdm(todo, total=total):
+                try:
+                    video_status, video_trace = run_video(args, video_key, video_info, frame_dbs)
                 except Exception as e:
-                    tqdm.write("{} : {}".format(jobs[future], e))
-                    fails.append(jobs[future])
+                    tqdm.write("{} : {}".format(video_info['path'], e))
+                    add_failure(fails, failure_cache, video_key, video_info['path'], e)
+                    video_trace = getattr(e, "trace", None)
                 else:
-                    tqdm.write("{} : {}".format(jobs[future], video_status))
-    else:
-        for video_key, video_info in tqdm(annotation.items()):
-            try:
-                video_status = process(args, video_key, video_info, frame_db)
-            except Exception as e:
-                tqdm.write("{} : {}".format(video_info['path'], e))
-                fails.append(video_info['path'])
-            else:
-                tqdm.write("{} : {}".format(video_info['path'], video_status))
-
-    frame_db.close()
+                    tqdm.write("{} : {}".format(video_info['path'], video_status))
+                    status_count[video_status] += 1
+                if profiler:
+                    profiler.add(video_trace)
+                if schedule:
+                    schedule.add(video_trace)
+    finally:
+        # Commit the pending clips, even when interrupted
+        if writers:
+            writer_failed, writer_errors = collect_writers(writers, queues, writer_fails)
+            for error in writer_errors:
+                print(error)
+        else:
+            for output, frame_db in zip(outputs, frame_dbs):
+                try:
+                    frame_db.close()
+                except Exception as e:
+                    # The videos of the last batch are in `failed`, and told below
+                    print("Can not close {}: {}".format(output.db_name, e))
+        if profiler:
+            profiler.close()
+
+    # The videos in a failed batch, which may have been told OK before the batch is written
+    if not writers:
+        writer_failed = [x for frame_db in frame_dbs for x in frame_db.failed.items()]
+    for video_key, e in writer_failed:
+        if video_key not in fails:
+            print("{} : {}".format(video_key, e))
+            fails.add(video_key, None, VideoError(e, "storage"))
+    fails.close()
+    if failure_cache is not None:
+        failure_cache.close()
+    if writers and writer_errors:
+        # The videos done are marked in the database, the others are done again by `--resume`
+        raise RuntimeError("\n".join(writer_errors + ["Run again with `--resume` for the videos not written"]))
 
     print("Processed {} videos".format(total))
+    if schedule:
+        schedule.report(time.perf_counter() - start)
+    for video_status, count in status_count.most_common():
+        print("  {} : {}".format(video_status, count))
     if not fails:
         print("All success! Congratulations!")
     else:
-        print("{} Success, {} Error".format(total - len(fails), len(fails)))
+        print("{} Success, {} Error, see {}".format(total - len(fails), len(fails), fails.path))
+        for reason, count in fails.reasons.most_common():
+            print("  {} : {}".format(reason, count))
 
-        annotation = {k: v for k, v in annotation.items() if v['path'] not in fails}
-        annotation_all["annotation"] = annotation
-        if args.annotation_file.lower().endswith(".json"):
-            save_path = args.annotation_file[:-5] + "-fix.json"
-        else:
-            save_path = args.annotation_file + "-fix.json"
-        json.dump(annotation_all, Path(save_path).open("w"), indent=4)
+        # The annotation without the failed videos, streamed from the manifest again
+        manifest.save(manifest.fix_path(args.shard_suffix),
+                      ((k, v) for k, v in iter_videos(manifest, args) if k not in fails))
 
     print("All Done!")